@@ -0,0 +1,213 @@
+"""
+Local stand-ins for the Big Local GraphQL API and the file storage it signs
+URLs for, so the plugin can be benchmarked without touching the network.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+import json
+import pathlib
+import re
+import threading
+import time
+
+range_re = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK_SIZE = 64 * 1024
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeBigLocal:
+    """
+    Serves the GraphQL API and file storage from background threads.
+
+    latency is seconds added before every response, bandwidth is the download
+    speed for files in bytes per second, or None for as fast as possible.
+    Every remember_token is accepted and becomes the ID of its user, which
+    makes it easy to simulate many different users.
+    """
+
+    def __init__(self, files_dir, latency=0, bandwidth=None, page_size=100):
+        self.files_dir = pathlib.Path(files_dir)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.page_size = page_size
+        self.servers = []
+
+    @property
+    def graphql_url(self):
+        return "http://127.0.0.1:{}/graphql".format(self.servers[0].server_port)
+
+    @property
+    def storage_url(self):
+        return "http://127.0.0.1:{}".format(self.servers[1].server_port)
+
+    def start(self):
+        for handler in (self.graphql_handler(), self.storage_handler()):
+            server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+    def file_info(self, path):
+        stat = path.stat()
+        return {
+            "name": path.name,
+            "size": float(stat.st_size),
+            "etag": '"{}-{}"'.format(stat.st_size, int(stat.st_mtime)),
+        }
+
+    def graphql_handler(self):
+        fake = self
+
+        class GraphQLHandler(QuietHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+                time.sleep(fake.latency)
+                token = self.headers.get("cookie", "").split("remember_token=")[-1]
+                query = body["query"]
+                variables = body.get("variables") or {}
+                if "createFileDownloadUri" in query:
+                    if "input" in variables:
+                        signed = {"createFileDownloadUri": variables["input"]}
+                    else:
+                        # Batched: f0 signs $input0, f1 signs $input1...
+                        signed = {
+                            "f" + key[len("input") :]: value
+                            for key, value in variables.items()
+                        }
+                    self.send_json(
+                        {
+                            "data": {
+                                alias: {
+                                    "ok": {
+                                        "name": input["fileName"],
+                                        "uri": "{}/{}".format(
+                                            fake.storage_url, quote(input["fileName"])
+                                        ),
+                                    },
+                                    "err": None,
+                                }
+                                for alias, input in signed.items()
+                            }
+                        }
+                    )
+                elif "user {" in query:
+                    self.send_json(
+                        {
+                            "data": {
+                                "user": {
+                                    "id": token,
+                                    "displayName": "User {}".format(token),
+                                    "username": "user-{}".format(token),
+                                    "email": "{}@example.com".format(token),
+                                }
+                            }
+                        }
+                    )
+                else:
+                    self.send_json({"data": {"node": fake.project(variables)}})
+
+        return GraphQLHandler
+
+    def project(self, variables):
+        project = {"id": variables["id"], "name": "benchmarks"}
+        if "after" in variables:
+            paths = sorted(self.files_dir.glob("*.csv"))
+            start = int(variables["after"] or 0)
+            end = start + self.page_size
+            project["files"] = {
+                "pageInfo": {
+                    "hasNextPage": end < len(paths),
+                    "endCursor": str(end),
+                },
+                "edges": [{"node": self.file_info(path)} for path in paths[start:end]],
+            }
+        return project
+
+    def storage_handler(self):
+        fake = self
+
+        class StorageHandler(QuietHandler):
+            def headers_for(self):
+                path = fake.files_dir / unquote(self.path.lstrip("/"))
+                if "/" in self.path.lstrip("/") or not path.is_file():
+                    self.send_response(404)
+                    self.send_header("content-length", "0")
+                    self.end_headers()
+                    return None, None
+                info = fake.file_info(path)
+                size = int(info["size"])
+                start, end = 0, size - 1
+                match = range_re.match(self.headers.get("range") or "")
+                if match and (match.group(1) or match.group(2)):
+                    if match.group(1):
+                        start = int(match.group(1))
+                        end = int(match.group(2) or end)
+                    else:
+                        start = size - int(match.group(2))
+                    end = min(end, size - 1)
+                    self.send_response(206)
+                    self.send_header(
+                        "content-range", "bytes {}-{}/{}".format(start, end, size)
+                    )
+                else:
+                    self.send_response(200)
+                self.send_header("etag", info["etag"])
+                self.send_header("accept-ranges", "bytes")
+                self.send_header("content-type", "text/csv")
+                self.send_header("content-length", str(end - start + 1))
+                self.end_headers()
+                return path, (start, end)
+
+            def do_HEAD(self):
+                time.sleep(fake.latency)
+                self.headers_for()
+
+            def do_GET(self):
+                time.sleep(fake.latency)
+                path, byte_range = self.headers_for()
+                if path is None:
+                    return
+                start, end = byte_range
+                remaining = end - start + 1
+                with open(path, "rb") as fp:
+                    fp.seek(start)
+                    while remaining > 0:
+                        chunk = fp.read(min(CHUNK_SIZE, remaining))
+                        if not chunk:
+                            break
+                        started = time.perf_counter()
+                        try:
+                            self.wfile.write(chunk)
+                        except (BrokenPipeError, ConnectionResetError):
+                            return
+                        remaining -= len(chunk)
+                        if fake.bandwidth:
+                            # Throttle to the configured bytes per second
+                            wait = len(chunk) / fake.bandwidth - (
+                                time.perf_counter() - started
+                            )
+                            if wait > 0:
+                                time.sleep(wait)
+
+        return StorageHandler
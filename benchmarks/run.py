@@ -0,0 +1,324 @@
+"""
+Benchmarks for datasette-big-local, run against local stand-ins for Big Local.
+
+    python benchmarks/run.py --sizes 1MB,10MB --output results.json
+    python benchmarks/run.py --compare results.json --output new-results.json
+
+Each import runs in a fresh subprocess so peak RSS is measured per file.
+"""
+from datasette.app import Datasette
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import math
+import pathlib
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent))
+from fake_big_local import FakeBigLocal  # noqa: E402
+
+PROJECT_UUID = "ff0150c6-b634-472a-81b2-ef2e0c01d224"
+PROJECT_ID = base64.b64encode("Project:{}".format(PROJECT_UUID).encode("utf-8")).decode(
+    "utf-8"
+)
+WIDTHS = {"narrow": 5, "wide": 50}
+UNITS = {"KB": 1024, "MB": 1024**2, "GB": 1024**3}
+WORDS = (
+    "school district budget police county election housing water permit "
+    "hospital contract salary vote fire transit court audit grant"
+).split()
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    return int(float(size[:-2]) * UNITS[size[-2:]])
+
+
+def generate_csv(path, size, width, seed=0):
+    """
+    Write a CSV of roughly size bytes with width columns of messy values:
+    integers, floats, dates, categories and free text, with blanks, stray
+    strings in numeric columns and quoted values containing commas.
+    """
+    rng = random.Random(seed)
+    kinds = [
+        ("integer", "float", "date", "category", "text")[i % 5] for i in range(width)
+    ]
+    headers = ["{}_{}".format(kind, i) for i, kind in enumerate(kinds)]
+
+    def value(kind):
+        if rng.random() < 0.05:
+            return ""
+        if kind == "integer":
+            return str(rng.randint(-1000, 10**6)) if rng.random() > 0.001 else "N/A"
+        if kind == "float":
+            return "{:.3f}".format(rng.uniform(-1000, 1000))
+        if kind == "date":
+            return (
+                datetime.date(2000, 1, 1)
+                + datetime.timedelta(days=rng.randint(0, 9000))
+            ).isoformat()
+        if kind == "category":
+            return rng.choice(WORDS)
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))
+        if rng.random() < 0.1:
+            text = '"{}, {}"'.format(text, rng.choice(WORDS))
+        return text
+
+    written = 0
+    with open(path, "w", newline="") as fp:
+        fp.write(",".join(headers) + "\n")
+        while written < size:
+            line = ",".join(value(kind) for kind in kinds) + "\n"
+            fp.write(line)
+            written += len(line)
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+
+    def nearest_rank(percent):
+        return timings[max(0, math.ceil(percent / 100 * len(timings)) - 1)]
+
+    return {
+        "p50": statistics.median(timings),
+        "p95": nearest_rank(95),
+        "p99": nearest_rank(99),
+        "max": timings[-1],
+    }
+
+
+def make_datasette(root_dir, graphql_url):
+    return Datasette(
+        metadata={
+            "plugins": {
+                "datasette-big-local": {
+                    "root_dir": str(root_dir),
+                    "graphql_url": graphql_url,
+                    "csv_size_limit_mb": 100 * 1024,
+                }
+            }
+        }
+    )
+
+
+async def benchmark_import(root_dir, graphql_url, filename, timeout):
+    "Runs in its own process: POST /-/big-local-open then wait for the rows"
+    from datasette_big_local import alnum_encode, get_open_databases
+
+    ds = make_datasette(root_dir, graphql_url)
+    table = alnum_encode(filename)
+    start = time.perf_counter()
+    response = await ds.client.post(
+        "/-/big-local-open",
+        data={
+            "project_id": PROJECT_ID,
+            "filename": filename,
+            "remember_token": "benchmark",
+        },
+    )
+    assert response.status_code == 302, response.text
+    cookies = {"ds_actor": response.cookies["ds_actor"]}
+    time_to_first_row = None
+    completed = None
+    progress = {}
+    while time.perf_counter() - start < timeout:
+        if time_to_first_row is None:
+            rows = await ds.client.get(
+                "/{}/{}.json?_shape=array&_size=1".format(PROJECT_UUID, table),
+                cookies=cookies,
+            )
+            if rows.status_code == 200 and rows.json():
+                time_to_first_row = time.perf_counter() - start
+        progress_response = await ds.client.get(
+            "/{}/_import_progress_.json?_shape=array&table={}&stage=import".format(
+                PROJECT_UUID, table
+            ),
+            cookies=cookies,
+        )
+        if progress_response.status_code == 200 and progress_response.json():
+            progress = progress_response.json()[0]
+            if progress["completed"]:
+                completed = time.perf_counter() - start
+                break
+        await asyncio.sleep(0.05)
+    # Indexes, stats and full-text search run after the import completes
+    while get_open_databases(ds).pins and time.perf_counter() - start < timeout:
+        await asyncio.sleep(0.05)
+    all_stages = time.perf_counter() - start
+    size = (pathlib.Path(root_dir) / "files" / filename).stat().st_size
+    return {
+        "time_to_first_row": time_to_first_row,
+        "import_seconds": completed,
+        "all_stages_seconds": all_stages,
+        "rows": progress.get("rows_done"),
+        "rows_per_second": (progress.get("rows_done") or 0) / completed
+        if completed
+        else None,
+        "mb_per_second": size / 1024 / 1024 / completed if completed else None,
+        # ru_maxrss is KB on Linux, bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / (1024 * 1024 if sys.platform == "darwin" else 1024),
+    }
+
+
+async def benchmark_permissions(root_dir, graphql_url, users, rounds):
+    "Time permission_allowed for N concurrent users, cold then cached"
+    ds = make_datasette(root_dir, graphql_url)
+    actors = [{"id": str(i), "token": str(i), "display": str(i)} for i in range(users)]
+
+    async def check(actor):
+        start = time.perf_counter()
+        allowed = await ds.permission_allowed(
+            actor, "view-database", resource=PROJECT_UUID
+        )
+        assert allowed
+        return time.perf_counter() - start
+
+    results = {}
+    for label in ["cold"] + ["cached"] * rounds:
+        timings = await asyncio.gather(*(check(actor) for actor in actors))
+        results.setdefault(label, []).extend(timings)
+    return {label: percentiles(timings) for label, timings in results.items()}
+
+
+def compare(previous, current):
+    "Print the percentage change for every number in matching results"
+    by_name = {result["name"]: result for result in previous["results"]}
+    for result in current["results"]:
+        before = by_name.get(result["name"])
+        if before is None:
+            continue
+        for key, value in flatten(result["metrics"]):
+            old = dict(flatten(before["metrics"])).get(key)
+            if (
+                isinstance(value, (int, float))
+                and isinstance(old, (int, float))
+                and old
+            ):
+                print(
+                    "{:<40} {:<40} {:>12.4f} {:>+8.1f}%".format(
+                        result["name"], key, value, (value - old) / old * 100
+                    )
+                )
+
+
+def flatten(metrics, prefix=""):
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            yield from flatten(value, prefix + key + ".")
+        else:
+            yield prefix + key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sizes", default="1MB,10MB,100MB")
+    parser.add_argument("--shapes", default="narrow,wide")
+    parser.add_argument("--users", default="1,10,100")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--bandwidth", type=parse_size, default=None)
+    parser.add_argument("--timeout", type=float, default=3600)
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", help="Earlier results JSON to compare with")
+    parser.add_argument("--single-import", help=argparse.SUPPRESS)
+    parser.add_argument("--root-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--graphql-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single_import:
+        result = asyncio.run(
+            benchmark_import(
+                args.root_dir, args.graphql_url, args.single_import, args.timeout
+            )
+        )
+        print(json.dumps(result))
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        files_dir = pathlib.Path(tmp) / "files"
+        files_dir.mkdir()
+        for shape in args.shapes.split(","):
+            for size in args.sizes.split(","):
+                filename = "{}_{}.csv".format(shape, size.strip().lower())
+                generate_csv(files_dir / filename, parse_size(size), WIDTHS[shape])
+        fake = FakeBigLocal(
+            files_dir, latency=args.latency, bandwidth=args.bandwidth
+        ).start()
+        try:
+            for path in sorted(files_dir.glob("*.csv")):
+                root_dir = pathlib.Path(tmp) / path.stem
+                root_dir.mkdir()
+                (root_dir / "files").symlink_to(files_dir)
+                output = subprocess.run(
+                    [
+                        sys.executable,
+                        __file__,
+                        "--single-import",
+                        path.name,
+                        "--root-dir",
+                        str(root_dir),
+                        "--graphql-url",
+                        fake.graphql_url,
+                        "--timeout",
+                        str(args.timeout),
+                    ],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                metrics = json.loads(output.strip().splitlines()[-1])
+                metrics["bytes"] = path.stat().st_size
+                results.append(
+                    {"name": "import:{}".format(path.stem), "metrics": metrics}
+                )
+                print(results[-1]["name"], json.dumps(metrics), file=sys.stderr)
+            for users in args.users.split(","):
+                root_dir = pathlib.Path(tmp) / "permissions-{}".format(users)
+                root_dir.mkdir()
+                metrics = asyncio.run(
+                    benchmark_permissions(
+                        root_dir, fake.graphql_url, int(users), args.rounds
+                    )
+                )
+                results.append(
+                    {"name": "permissions:{}_users".format(users), "metrics": metrics}
+                )
+                print(results[-1]["name"], json.dumps(metrics), file=sys.stderr)
+        finally:
+            fake.stop()
+
+    import datasette
+
+    report = {
+        "created": datetime.datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "datasette": datasette.__version__,
+        "options": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("single_import", "root_dir", "graphql_url")
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as fp:
+        json.dump(report, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), report)
+
+
+if __name__ == "__main__":
+    main()
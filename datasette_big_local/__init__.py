@@ -1,34 +1,149 @@
 from cachetools import TTLCache
 from datasette import hookimpl
-from datasette.database import Database
-from datasette.utils.asgi import Response
+from datasette.database import Database, Results
+from datasette.utils.asgi import Request, Response
+from itsdangerous import BadSignature
+import abc
 import asyncio
 import base64
+import collections
+import contextlib
 import html
 import httpx
 import pathlib
 
-import functools
+import hashlib
 import uuid
 import csv as csv_std
 import datetime
+import decimal
+import heapq
+import importlib.util
+import io
+import json
+import tempfile
 import threading
+import time
+import types
 
 import sqlite_utils
 from sqlite_utils.utils import TypeTracker
-from urllib.parse import urlencode
+from urllib.parse import parse_qs, urlencode
 import re
+import sqlite3
+import sys
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: imports are only coordinated within a single process
+    fcntl = None
 
 ALLOWED = "abcdefghijklmnopqrstuvwxyz" "ABCDEFGHIJKLMNOPQRSTUVWXYZ" "0123456789"
 split_re = re.compile("(_[0-9a-f]+_)")
+database_path_re = re.compile(
+    r"^/([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(?:[/.]|$)"
+)
+# Table and row pages, in any format
+table_path_re = re.compile(
+    r"^/([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"
+    r"/(\w+)(?:\.\w+)?(?:/[^/]+)?$"
+)
+# Queries Datasette runs for an unfiltered table page, which stored stats answer
+name_pattern = r"(\w+|\[[^\]]+\])"
+count_sql_re = re.compile(r"^\s*select count\(\*\) from {}\s*$".format(name_pattern))
+# Results of these depend on more than the data, so are never cached
+uncacheable_sql_re = re.compile(r"random|'now'|current_(date|time)", re.I)
+suggest_facet_sql_re = re.compile(
+    r"^\s*select {column} as value, count\(\*\) as n from \(\s*"
+    r"select [^()]*? from {table}\s*\) where value is not null\s*"
+    r"group by value\s*limit (?P<limit>\d+)\s*$".format(
+        column=name_pattern.replace("(", "(?P<column>", 1),
+        table=name_pattern.replace("(", "(?P<table>", 1),
+    )
+)
+
+
+# Seconds each GraphQL operation may take before it counts as a failure.
+# Permission checks hold up page loads, so they get the tightest budget
+GRAPHQL_TIMEOUTS = {
+    "get_project": 5,
+    "get_project_files": 30,
+    "get_big_local_user": 5,
+    "createFileDownloadUri": 10,
+    "createFileDownloadUris": 30,
+    "probe": 5,
+}
 
 
 class Settings:
-    def __init__(self, root_dir, graphql_url, csv_size_limit_mb, login_redirect_url):
+    def __init__(
+        self,
+        root_dir,
+        graphql_url,
+        csv_size_limit_mb,
+        login_redirect_url,
+        max_open_databases,
+        sqlite_journal_mode,
+        sqlite_synchronous,
+        sqlite_mmap_size,
+        sqlite_cache_size,
+        sqlite_page_size,
+        sqlite_import_pragmas,
+        auto_index,
+        auto_index_max_indexes,
+        auto_index_min_rows,
+        auto_index_max_null_rate,
+        auto_fts,
+        fts_min_average_length,
+        fts_batch_size,
+        files_refresh_after,
+        prefetch_size_limit_mb,
+        prefetch_max_files,
+        bulk_import_concurrency,
+        disk_budget_mb,
+        project_quota_mb,
+        graphql_timeouts,
+        circuit_breaker_failures,
+        circuit_breaker_probe_seconds,
+        stale_permission_ttl,
+        stale_grant_ttl,
+        query_cache_mb,
+        query_cache_max_result_kb,
+        admins,
+    ):
         self.root_dir = root_dir
         self.graphql_url = graphql_url
         self.csv_size_limit_mb = csv_size_limit_mb
         self.login_redirect_url = login_redirect_url
+        self.max_open_databases = max_open_databases
+        self.sqlite_journal_mode = sqlite_journal_mode
+        self.sqlite_synchronous = sqlite_synchronous
+        self.sqlite_mmap_size = sqlite_mmap_size
+        self.sqlite_cache_size = sqlite_cache_size
+        self.sqlite_page_size = sqlite_page_size
+        self.sqlite_import_pragmas = sqlite_import_pragmas
+        self.auto_index = auto_index
+        self.auto_index_max_indexes = auto_index_max_indexes
+        self.auto_index_min_rows = auto_index_min_rows
+        self.auto_index_max_null_rate = auto_index_max_null_rate
+        self.auto_fts = auto_fts
+        self.fts_min_average_length = fts_min_average_length
+        self.fts_batch_size = fts_batch_size
+        self.files_refresh_after = files_refresh_after
+        self.prefetch_size_limit_mb = prefetch_size_limit_mb
+        self.prefetch_max_files = prefetch_max_files
+        self.bulk_import_concurrency = bulk_import_concurrency
+        self.disk_budget_mb = disk_budget_mb
+        self.project_quota_mb = project_quota_mb
+        self.graphql_timeouts = graphql_timeouts
+        self.circuit_breaker_failures = circuit_breaker_failures
+        self.circuit_breaker_probe_seconds = circuit_breaker_probe_seconds
+        self.stale_permission_ttl = stale_permission_ttl
+        self.stale_grant_ttl = stale_grant_ttl
+        self.query_cache_mb = query_cache_mb
+        self.query_cache_max_result_kb = query_cache_max_result_kb
+        self.admins = admins
 
 
 def get_settings(datasette):
@@ -40,9 +155,55 @@ def get_settings(datasette):
         csv_size_limit_mb=plugin_config.get("csv_size_limit_mb") or 100,
         login_redirect_url=plugin_config.get("login_redirect_url")
         or "https://biglocalnews.org/#/datasette?",
+        max_open_databases=plugin_config.get("max_open_databases") or 50,
+        sqlite_journal_mode=plugin_config.get("sqlite_journal_mode") or "wal",
+        sqlite_synchronous=plugin_config.get("sqlite_synchronous") or "normal",
+        sqlite_mmap_size=plugin_config.get("sqlite_mmap_size", 256 * 1024 * 1024),
+        sqlite_cache_size=plugin_config.get("sqlite_cache_size", -16000),
+        sqlite_page_size=plugin_config.get("sqlite_page_size") or 4096,
+        sqlite_import_pragmas=plugin_config.get(
+            "sqlite_import_pragmas",
+            {"synchronous": "off", "temp_store": "memory", "cache_size": -64000},
+        ),
+        auto_index=plugin_config.get("auto_index", True),
+        auto_index_max_indexes=plugin_config.get("auto_index_max_indexes", 5),
+        auto_index_min_rows=plugin_config.get("auto_index_min_rows", 1000),
+        auto_index_max_null_rate=plugin_config.get("auto_index_max_null_rate", 0.5),
+        auto_fts=plugin_config.get("auto_fts", False),
+        fts_min_average_length=plugin_config.get("fts_min_average_length", 15),
+        fts_batch_size=plugin_config.get("fts_batch_size") or 10000,
+        files_refresh_after=plugin_config.get("files_refresh_after", 60 * 4),
+        prefetch_size_limit_mb=plugin_config.get("prefetch_size_limit_mb") or 0,
+        prefetch_max_files=plugin_config.get("prefetch_max_files", 10),
+        bulk_import_concurrency=plugin_config.get("bulk_import_concurrency") or 3,
+        disk_budget_mb=plugin_config.get("disk_budget_mb") or 0,
+        project_quota_mb=plugin_config.get("project_quota_mb") or 0,
+        graphql_timeouts=dict(
+            GRAPHQL_TIMEOUTS, **(plugin_config.get("graphql_timeouts") or {})
+        ),
+        circuit_breaker_failures=plugin_config.get("circuit_breaker_failures") or 5,
+        circuit_breaker_probe_seconds=plugin_config.get(
+            "circuit_breaker_probe_seconds", 10
+        ),
+        stale_permission_ttl=plugin_config.get("stale_permission_ttl", 60 * 60),
+        stale_grant_ttl=plugin_config.get("stale_grant_ttl") or 0,
+        query_cache_mb=plugin_config.get("query_cache_mb") or 0,
+        query_cache_max_result_kb=plugin_config.get("query_cache_max_result_kb")
+        or 1024,
+        admins=plugin_config.get("admins") or [],
     )
 
 
+pragma_re = re.compile(r"^-?\w+$")
+
+
+def set_pragma(conn, name, value):
+    # Values come from plugin configuration, but check them anyway
+    if not pragma_re.match(name) or not pragma_re.match(str(value)):
+        raise ValueError("Invalid pragma: {}={}".format(name, value))
+    conn.execute("PRAGMA {} = {}".format(name, value))
+
+
 @hookimpl
 def forbidden(request, datasette):
     database_name = request.url_vars["database"]
@@ -56,16 +217,356 @@ def forbidden(request, datasette):
     return Response.redirect(url)
 
 
+class MeteredTTLCache(TTLCache):
+    "TTLCache that counts hits, misses and evictions in the plugin metrics"
+
+    def __init__(self, metrics, *args, **kwargs):
+        self.metrics = metrics
+        super().__init__(*args, **kwargs)
+
+    def get(self, key, default=None):
+        if key in self:
+            self.metrics.inc("big_local_cache_hits_total")
+            return self[key]
+        self.metrics.inc("big_local_cache_misses_total")
+        return default
+
+    def popitem(self):
+        self.metrics.inc("big_local_cache_evictions_total", reason="size")
+        return super().popitem()
+
+    def expire(self, *args, **kwargs):
+        expired = super().expire(*args, **kwargs)
+        if expired:
+            self.metrics.inc(
+                "big_local_cache_evictions_total", len(expired), reason="ttl"
+            )
+        return expired
+
+
 def get_cache(datasette):
     cache = getattr(datasette, "big_local_cache", None)
     if cache is None:
-        datasette.big_local_cache = cache = TTLCache(maxsize=100, ttl=60 * 5)
+        datasette.big_local_cache = cache = MeteredTTLCache(
+            get_metrics(datasette), maxsize=100, ttl=60 * 5
+        )
     return cache
 
 
+METRICS = {
+    "big_local_import_rows_total": ("counter", "Rows imported"),
+    "big_local_import_bytes_total": ("counter", "Bytes downloaded by imports"),
+    "big_local_active_imports": ("gauge", "Imports currently running"),
+    "big_local_write_queue_depth": ("gauge", "Writes queued for project databases"),
+    "big_local_open_databases": ("gauge", "Project databases attached to Datasette"),
+    "big_local_write_batch_seconds": (
+        "histogram",
+        "Time spent inserting each batch of imported rows",
+    ),
+    "big_local_cache_hits_total": ("counter", "Permission cache hits"),
+    "big_local_cache_misses_total": ("counter", "Permission cache misses"),
+    "big_local_cache_evictions_total": ("counter", "Permission cache evictions"),
+    "big_local_cache_size": ("gauge", "Entries in the permission cache"),
+    "big_local_graphql_seconds": ("histogram", "Big Local GraphQL API latency"),
+    "big_local_query_cache_hits_total": ("counter", "Query result cache hits"),
+    "big_local_query_cache_misses_total": ("counter", "Query result cache misses"),
+    "big_local_query_cache_evictions_total": (
+        "counter",
+        "Query results dropped from the cache, by reason",
+    ),
+    "big_local_query_cache_bytes": (
+        "gauge",
+        "Estimated size of the results in the query cache",
+    ),
+    "big_local_graphql_failures_total": (
+        "counter",
+        "GraphQL requests that timed out, could not connect or got a 5xx",
+    ),
+    "big_local_circuit_open": (
+        "gauge",
+        "1 while the GraphQL circuit breaker is failing calls fast",
+    ),
+    "big_local_circuit_fast_failures_total": (
+        "counter",
+        "GraphQL calls failed without being sent because the circuit was open",
+    ),
+    "big_local_stale_permissions_total": (
+        "counter",
+        "Permission checks answered from expired decisions while GraphQL was down",
+    ),
+    "big_local_storage_seconds": (
+        "histogram",
+        "Latency of file storage requests, to response headers",
+    ),
+    "big_local_prefetch_imports_total": (
+        "counter",
+        "Background imports of small files, by outcome",
+    ),
+    "big_local_bulk_imports_total": (
+        "counter",
+        "Files imported by whole-project imports, by outcome",
+    ),
+    "big_local_not_modified_total": (
+        "counter",
+        "Table requests answered with 304 Not Modified",
+    ),
+    "big_local_evicted_tables_total": (
+        "counter",
+        "Imported tables dropped to stay within disk limits",
+    ),
+    "big_local_reimports_total": (
+        "counter",
+        "Evicted tables imported again when they were next visited",
+    ),
+}
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metrics:
+    "Counters and histograms kept in memory, rendered in Prometheus text format"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) => value, labels being a sorted tuple of pairs
+        self.values = collections.Counter()
+        # (name, labels) => [count per bucket..., sum, count]
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] += value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(HISTOGRAM_BUCKETS) + 2)
+            for i, bucket in enumerate(HISTOGRAM_BUCKETS):
+                if seconds <= bucket:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self, gauges=None):
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        values.update(gauges or {})
+        lines = []
+        for name, (type_, help) in METRICS.items():
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, type_))
+            if type_ != "histogram":
+                for (key_name, labels), value in sorted(values.items()):
+                    if key_name == name:
+                        lines.append(
+                            "{}{} {}".format(name, format_labels(labels), value)
+                        )
+                continue
+            for (key_name, labels), histogram in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                for bucket, count in zip(HISTOGRAM_BUCKETS, histogram):
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            name, format_labels(labels + (("le", bucket),)), count
+                        )
+                    )
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        name, format_labels(labels + (("le", "+Inf"),)), histogram[-1]
+                    )
+                )
+                lines.append(
+                    "{}_sum{} {}".format(name, format_labels(labels), histogram[-2])
+                )
+                lines.append(
+                    "{}_count{} {}".format(name, format_labels(labels), histogram[-1])
+                )
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for key, value in labels
+        )
+    )
+
+
+def get_metrics(datasette):
+    metrics = getattr(datasette, "big_local_metrics", None)
+    if metrics is None:
+        datasette.big_local_metrics = metrics = Metrics()
+    return metrics
+
+
+class BigLocalUnavailable(Exception):
+    "The GraphQL API is down, too slow, or the circuit breaker is open"
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive GraphQL failures. After failure_threshold of them the
+    circuit opens and calls fail immediately instead of waiting on the API,
+    until a background probe gets an answer and closes it again.
+    """
+
+    def __init__(self, failure_threshold):
+        self.failure_threshold = failure_threshold
+        self.state = "closed"
+        self.failures = 0
+        self.opened = None
+        self.last_error = None
+        self.probes = 0
+        self.prober = None
+
+    def record_success(self):
+        self.failures = 0
+        self.state = "closed"
+        self.opened = None
+
+    def record_failure(self, error):
+        "Returns True if this failure opened the circuit"
+        self.failures += 1
+        self.last_error = error
+        if self.state == "closed" and self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened = time.monotonic()
+            return True
+        return False
+
+    def summary(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "failure_threshold": self.failure_threshold,
+            "open_seconds": round(time.monotonic() - self.opened, 3)
+            if self.opened is not None
+            else None,
+            "last_error": self.last_error,
+            "probes": self.probes,
+        }
+
+
+def get_circuit_breaker(datasette):
+    breaker = getattr(datasette, "big_local_circuit_breaker", None)
+    if breaker is None:
+        breaker = CircuitBreaker(get_settings(datasette).circuit_breaker_failures)
+        datasette.big_local_circuit_breaker = breaker
+    return breaker
+
+
+async def graphql_request(datasette, client, operation, body, remember_token=None):
+    """
+    POST body to the GraphQL API within the latency budget for operation.
+    Raises BigLocalUnavailable on timeouts, connection errors and 5xx
+    responses, or straight away if the circuit breaker is open.
+    """
+    settings = get_settings(datasette)
+    metrics = get_metrics(datasette)
+    breaker = get_circuit_breaker(datasette)
+    if breaker.state == "open" and operation != "probe":
+        metrics.inc("big_local_circuit_fast_failures_total", operation=operation)
+        raise BigLocalUnavailable("Big Local API is unavailable")
+    cookies = {"remember_token": remember_token} if remember_token else None
+    error = None
+    try:
+        with metrics.timer("big_local_graphql_seconds", operation=operation):
+            response = await client.post(
+                settings.graphql_url,
+                json=body,
+                cookies=cookies,
+                timeout=settings.graphql_timeouts[operation],
+            )
+    except httpx.TimeoutException:
+        error = "{} timed out".format(operation)
+    except httpx.TransportError as e:
+        error = "{} failed: {}".format(operation, e.__class__.__name__)
+    else:
+        if response.status_code >= 500:
+            error = "{} returned {}".format(operation, response.status_code)
+    if error is None:
+        breaker.record_success()
+        return response
+    metrics.inc("big_local_graphql_failures_total", operation=operation)
+    if operation != "probe" and breaker.record_failure(error):
+        breaker.prober = asyncio.ensure_future(probe_until_recovered(datasette))
+    raise BigLocalUnavailable(error)
+
+
+async def probe_until_recovered(datasette):
+    "Runs while the circuit is open, closing it once the API answers again"
+    breaker = get_circuit_breaker(datasette)
+    interval = get_settings(datasette).circuit_breaker_probe_seconds
+    try:
+        async with httpx.AsyncClient() as client:
+            while breaker.state == "open":
+                await asyncio.sleep(interval)
+                breaker.probes += 1
+                try:
+                    # Any answer at all, even an error about the missing
+                    # token, means the API is back
+                    await graphql_request(
+                        datasette, client, "probe", {"query": "query { __typename }"}
+                    )
+                except BigLocalUnavailable as e:
+                    breaker.last_error = str(e)
+    finally:
+        breaker.prober = None
+
+
+def get_stale_permissions(datasette):
+    # Decisions outlive the permission cache so they can be served when
+    # GraphQL is down, as (allowed, time.monotonic() when decided). Denials
+    # are kept for stale_permission_ttl, grants only for stale_grant_ttl, as
+    # users removed from a project would keep access while they are served
+    stale = getattr(datasette, "big_local_stale_permissions", None)
+    if stale is None:
+        settings = get_settings(datasette)
+        datasette.big_local_stale_permissions = stale = TTLCache(
+            maxsize=10000,
+            ttl=max(settings.stale_permission_ttl, settings.stale_grant_ttl),
+        )
+    return stale
+
+
+def stale_permission(datasette, key):
+    "The last decision for key that can still be served, or None"
+    settings = get_settings(datasette)
+    decision = get_stale_permissions(datasette).get(key)
+    if decision is None:
+        return None
+    allowed, decided = decision
+    ttl = settings.stale_grant_ttl if allowed else settings.stale_permission_ttl
+    if time.monotonic() - decided > ttl:
+        return None
+    return allowed
+
+
 @hookimpl
 def permission_allowed(datasette, actor, action, resource):
     async def inner():
+        if action == "big-local-admin":
+            if actor and (
+                actor.get("id") == "root"
+                or actor.get("id") in get_settings(datasette).admins
+            ):
+                return True
+            return
         if action not in ("view-database", "execute-sql"):
             # No opinion
             return
@@ -93,9 +594,20 @@ def permission_allowed(datasette, actor, action, resource):
             result = True
         except (ProjectPermissionError, ProjectNotFoundError):
             result = False
+        except BigLocalUnavailable:
+            # Serve the last answer if there is one, otherwise deny without
+            # caching, which sends the user through forbidden() to sign in
+            result = stale_permission(datasette, key)
+            if result is None:
+                return False
+            get_metrics(datasette).inc("big_local_stale_permissions_total")
+            return result
 
         # Store in cache
         cache[key] = result
+        settings = get_settings(datasette)
+        if settings.stale_grant_ttl if result else settings.stale_permission_ttl:
+            get_stale_permissions(datasette)[key] = (result, time.monotonic())
         return result
 
     return inner
@@ -110,11 +622,16 @@ class ProjectNotFoundError(Exception):
 
 
 FILES = """
-                            files(first:100) {
+                            files(first: 100, after: $after) {
+                                pageInfo {
+                                    hasNextPage
+                                    endCursor
+                                }
                                 edges {
                                     node {
                                         name
                                         size
+                                        etag
                                     }
                                 }
                             }
@@ -123,41 +640,124 @@ FILES = """
 
 async def get_project(datasette, project_id, remember_token, files=False):
     async with httpx.AsyncClient() as client:
-        response = await client.post(
-            get_settings(datasette).graphql_url,
-            json={
-                "variables": {"id": project_id},
-                "query": """
-                query Node($id: ID!) {
-                    node(id: $id) {
-                        ... on Project {
-                            id
-                            name
-                            FILES
-                        }
+
+        async def fetch_page(after=None):
+            variables = {"id": project_id}
+            if files:
+                variables["after"] = after
+            query = """
+            query Node($id: ID!ARGS) {
+                node(id: $id) {
+                    ... on Project {
+                        id
+                        name
+                        FILES
                     }
                 }
-                """.replace(
-                    "FILES", FILES if files else ""
-                ),
-            },
-            cookies={"remember_token": remember_token},
-            timeout=30,
-        )
-    if response.status_code != 200:
-        raise ProjectPermissionError(response.text)
-    else:
-        data = response.json()["data"]
-        if data["node"] is None:
-            raise ProjectNotFoundError("Project not found")
-    project = data["node"]
-    # Clean up the files nested data
-    if files:
-        files_edges = project.pop("files")
-        project["files"] = [edge["node"] for edge in files_edges["edges"]]
+            }
+            """.replace(
+                "ARGS", ", $after: String" if files else ""
+            ).replace(
+                "FILES", FILES if files else ""
+            )
+            response = await graphql_request(
+                datasette,
+                client,
+                "get_project_files" if files else "get_project",
+                {"variables": variables, "query": query},
+                remember_token,
+            )
+            if response.status_code != 200:
+                raise ProjectPermissionError(response.text)
+            else:
+                data = response.json()["data"]
+                if data["node"] is None:
+                    raise ProjectNotFoundError("Project not found")
+            return data["node"]
+
+        project = await fetch_page()
+        # Clean up the files nested data, following the cursor for more pages
+        if files:
+            files_connection = project.pop("files")
+            project["files"] = [edge["node"] for edge in files_connection["edges"]]
+            page_info = files_connection.get("pageInfo") or {}
+            while page_info.get("hasNextPage"):
+                files_connection = (await fetch_page(page_info["endCursor"]))["files"]
+                project["files"].extend(
+                    edge["node"] for edge in files_connection["edges"]
+                )
+                page_info = files_connection.get("pageInfo") or {}
     return project
 
 
+class ProjectFiles:
+    "File listings for each project, refreshed in the background once they are old"
+
+    def __init__(self):
+        # project_id => {"files": [...], "fetched": monotonic, "token": ...}
+        self.entries = {}
+        self.refreshing = set()
+
+
+def get_project_files(datasette):
+    project_files = getattr(datasette, "big_local_project_files", None)
+    if project_files is None:
+        datasette.big_local_project_files = project_files = ProjectFiles()
+    return project_files
+
+
+def store_project_files(datasette, project_id, files, remember_token):
+    project_files = get_project_files(datasette)
+    now = time.monotonic()
+    # Encode table names once here rather than on every page render
+    for file in files:
+        file["table_name"] = alnum_encode(file["name"])
+    # The token is kept so the listing can be refreshed without a user request
+    project_files.entries[project_id] = {
+        "files": files,
+        "fetched": now,
+        "token": remember_token,
+    }
+    queue_prefetches(datasette, project_id, files, remember_token)
+
+
+def cached_project_files(datasette, project_id):
+    """
+    Returns the cached listing, or None, without ever waiting on GraphQL. Old
+    listings are still returned while a refresh runs in the background, so
+    projects nobody has looked at for a while still list their files.
+    """
+    project_files = get_project_files(datasette)
+    entry = project_files.entries.get(project_id)
+    if entry is None:
+        return None
+    age = time.monotonic() - entry["fetched"]
+    if age > get_settings(datasette).files_refresh_after and project_id not in (
+        project_files.refreshing
+    ):
+        project_files.refreshing.add(project_id)
+        asyncio.ensure_future(
+            refresh_project_files(datasette, project_id, entry["token"])
+        )
+    return entry["files"]
+
+
+async def refresh_project_files(datasette, project_id, remember_token):
+    project_files = get_project_files(datasette)
+    try:
+        project = await get_project(datasette, project_id, remember_token, True)
+    except (ProjectPermissionError, ProjectNotFoundError):
+        # That token no longer works, so the listing can't be kept up to date
+        project_files.entries.pop(project_id, None)
+        return
+    except BigLocalUnavailable:
+        # Keep showing what we have - the next render tries again
+        return
+    finally:
+        project_files.refreshing.discard(project_id)
+    store_project_files(datasette, project_id, project["files"], remember_token)
+
+
 def alnum_encode(s):
     encoded = []
     for char in s:
@@ -187,7 +787,6 @@ class OpenError(Exception):
 
 
 async def open_project_file(datasette, project_id, filename, remember_token):
-    graphql_endpoint = get_settings(datasette).graphql_url
     body = {
         "operationName": "CreateFileDownloadURI",
         "variables": {
@@ -210,12 +809,10 @@ async def open_project_file(datasette, project_id, filename, remember_token):
         }
         """,
     }
+    metrics = get_metrics(datasette)
     async with httpx.AsyncClient() as client:
-        response = await client.post(
-            graphql_endpoint,
-            json=body,
-            cookies={"remember_token": remember_token},
-            timeout=30,
+        response = await graphql_request(
+            datasette, client, "createFileDownloadUri", body, remember_token
         )
         if response.status_code != 200:
             raise OpenError(response.text)
@@ -225,14 +822,100 @@ async def open_project_file(datasette, project_id, filename, remember_token):
         # We need to do a HEAD request because the GraphQL endpoint doesn't
         # check if the file exists, it just signs whatever filename we sent
         uri = data["createFileDownloadUri"]["ok"]["uri"]
+        etag, length = await head_file(client, metrics, uri)
+    return uri, etag, length
+
+
+async def head_file(client, metrics, uri):
+    "Returns (etag, length) for a signed URI, or raises OpenError"
+    with metrics.timer("big_local_storage_seconds", method="HEAD"):
         head_response = await client.head(uri)
-        if head_response.status_code != 200:
-            raise OpenError("File not found")
-    return (
-        uri,
-        head_response.headers["etag"],
-        int(head_response.headers["content-length"]),
-    )
+    if head_response.status_code != 200:
+        raise OpenError("File not found")
+    return head_response.headers["etag"], int(head_response.headers["content-length"])
+
+
+# Aliased mutations signed per GraphQL request, and HEAD requests in flight
+SIGN_BATCH_SIZE = 50
+HEAD_CONCURRENCY = 10
+
+
+async def sign_project_files(datasette, project_id, filenames, remember_token):
+    """
+    Sign download URIs for many files with one aliased GraphQL mutation per
+    SIGN_BATCH_SIZE files. Returns {filename: uri or OpenError}
+    """
+    signed = {}
+    async with httpx.AsyncClient() as client:
+        for start in range(0, len(filenames), SIGN_BATCH_SIZE):
+            batch = filenames[start : start + SIGN_BATCH_SIZE]
+            query = "mutation CreateFileDownloadURIs({}) {{\n{}\n}}".format(
+                ", ".join(
+                    "$input{}: FileURIInput!".format(i) for i in range(len(batch))
+                ),
+                "\n".join(
+                    "f{i}: createFileDownloadUri(input: $input{i}) "
+                    "{{ ok {{ name uri }} err }}".format(i=i)
+                    for i in range(len(batch))
+                ),
+            )
+            variables = {
+                "input{}".format(i): {"fileName": filename, "projectId": project_id}
+                for i, filename in enumerate(batch)
+            }
+            body = {
+                "operationName": "CreateFileDownloadURIs",
+                "variables": variables,
+                "query": query,
+            }
+            try:
+                response = await graphql_request(
+                    datasette, client, "createFileDownloadUris", body, remember_token
+                )
+            except BigLocalUnavailable as e:
+                for filename in batch:
+                    signed[filename] = OpenError(str(e))
+                continue
+            if response.status_code != 200:
+                for filename in batch:
+                    signed[filename] = OpenError(response.text)
+                continue
+            data = response.json().get("data") or {}
+            for i, filename in enumerate(batch):
+                result = data.get("f{}".format(i)) or {"err": "Could not sign URI"}
+                if result["err"]:
+                    signed[filename] = OpenError(result["err"])
+                else:
+                    signed[filename] = result["ok"]["uri"]
+    return signed
+
+
+async def open_project_files(datasette, project_id, filenames, remember_token):
+    """
+    open_project_file for many files at once: one signing request per batch
+    then concurrent HEAD requests. Returns {filename: (uri, etag, length) or
+    OpenError}
+    """
+    signed = await sign_project_files(datasette, project_id, filenames, remember_token)
+    metrics = get_metrics(datasette)
+    semaphore = asyncio.Semaphore(HEAD_CONCURRENCY)
+
+    async with httpx.AsyncClient() as client:
+
+        async def check(filename):
+            uri = signed[filename]
+            if isinstance(uri, OpenError):
+                return filename, uri
+            async with semaphore:
+                try:
+                    etag, length = await head_file(client, metrics, uri)
+                except OpenError as e:
+                    return filename, e
+                except httpx.HTTPError as e:
+                    return filename, OpenError(str(e))
+            return filename, (uri, etag, length)
+
+        return dict(await asyncio.gather(*(check(filename) for filename in filenames)))
 
 
 def project_id_to_uuid(project_id):
@@ -245,19 +928,916 @@ def project_uuid_to_id(project_uuid):
     )
 
 
+# How often the cached table names double-check the schema version
+SCHEMA_CHECK_SECONDS = 5
+
+
+class StatsRow(tuple):
+    "A row answered from stored stats, indexed by position or name like sqlite3.Row"
+
+    def __new__(cls, columns, values):
+        row = super().__new__(cls, values)
+        row.columns = columns
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self.columns.index(key)
+        return super().__getitem__(key)
+
+    def keys(self):
+        return list(self.columns)
+
+
+class ProjectDatabase(Database):
+    """
+    A Big Local project database that can be detached and closed when idle,
+    then attached again the next time it is needed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Read connections by thread ident, so they can all be closed
+        self._thread_connections = {}
+        # Reads, queued writes and HTTP requests using this database. Writes
+        # finish on the write thread, hence the lock
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        # Table names, plus tables with an import starting, for the database page
+        self._table_names = None
+        self._importing_tables = set()
+        self._schema_version = None
+        self._schema_checked = 0
+        # Stats for imported tables, loaded from _table_stats_ on first use and
+        # reloaded now and then, as other workers may have imported tables
+        self._table_stats = None
+        self._table_stats_version = 0
+        self._table_stats_loaded = 0
+        # (source etag, completed) for completed tables, for HTTP caching
+        self._table_validators = None
+        self._table_validators_version = 0
+        self._table_validators_loaded = 0
+        # Unix times tables were last visited, saved to _table_access_ on writes
+        self._table_access = {}
+        # Tables dropped to save disk space, loaded from _evicted_tables_
+        self._evicted_tables = None
+        self._evicted_tables_loaded = 0
+        # Pragma values to restore once the last running import finishes
+        self._imports_running = 0
+        self._pragmas_before_import = {}
+        # Set once the write connection has brought older side tables up to date
+        self._migrated = False
+        # Set once detached: anything still holding this object is sent on to
+        # the database attached for the same file, so there is only ever one
+        # write thread per file
+        self._closed = False
+
+    def connect(self, write=False):
+        conn = super().connect(write=write)
+        settings = get_settings(self.ds)
+        if write and self.ds.executor is not None:
+            # The write thread closes its own connection once it has run every
+            # queued write, so super().close() must not close it first
+            self._all_file_connections.remove(conn)
+        if write:
+            # Persistent, so this also converts files created before it was set
+            set_pragma(conn, "journal_mode", settings.sqlite_journal_mode)
+            set_pragma(conn, "synchronous", settings.sqlite_synchronous)
+            migrate_import_progress(conn)
+            self._migrated = True
+        set_pragma(conn, "mmap_size", int(settings.sqlite_mmap_size))
+        set_pragma(conn, "cache_size", int(settings.sqlite_cache_size))
+        return conn
+
+    def begin_bulk_import(self, conn):
+        # Runs on the write thread, so the counter needs no lock
+        self._imports_running += 1
+        if self._imports_running > 1:
+            return
+        for name, value in get_settings(self.ds).sqlite_import_pragmas.items():
+            self._pragmas_before_import[name] = conn.execute(
+                "PRAGMA {}".format(name)
+            ).fetchone()[0]
+            set_pragma(conn, name, value)
+
+    def end_bulk_import(self, conn):
+        self._imports_running -= 1
+        if self._imports_running > 0:
+            return
+        for name, value in self._pragmas_before_import.items():
+            set_pragma(conn, name, value)
+        self._pragmas_before_import = {}
+
+    def attached(self):
+        "The open database for this file, attaching it again if need be"
+        if self.ds.databases.get(self.name) is self:
+            self.ds.remove_database(self.name)
+        db = reattach_database(self.ds, self.name)
+        if db is None:
+            raise sqlite3.OperationalError(
+                "Database {} no longer exists".format(self.name)
+            )
+        return db
+
+    async def execute_fn(self, fn):
+        if self._closed:
+            return await self.attached().execute_fn(fn)
+        if not self._migrated:
+            # Opening the write connection migrates _import_progress_, which
+            # reads of databases from older versions rely on
+            await self.execute_write_fn(lambda conn: None)
+        if self.ds.executor is None:
+            return await super().execute_fn(fn)
+
+        # Datasette keeps read connections in a threading.local() keyed on
+        # database name, which can't be cleared on close - so track our own
+        def in_thread():
+            key = threading.get_ident()
+            conn = self._thread_connections.get(key)
+            if conn is None:
+                conn = self.connect()
+                self.ds._prepare_connection(conn, self.name)
+                self._thread_connections[key] = conn
+            return fn(conn)
+
+        self.started_using()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                self.ds.executor, in_thread
+            )
+        finally:
+            self.finished_using()
+
+    def started_using(self):
+        with self._in_flight_lock:
+            self._in_flight += 1
+
+    def finished_using(self):
+        with self._in_flight_lock:
+            self._in_flight -= 1
+
+    @property
+    def is_busy(self):
+        return self._in_flight > 0
+
+    async def execute(
+        self,
+        sql,
+        params=None,
+        truncate=False,
+        custom_time_limit=None,
+        page_size=None,
+        log_sql_errors=True,
+    ):
+        if self._closed:
+            return await self.attached().execute(
+                sql,
+                params,
+                truncate=truncate,
+                custom_time_limit=custom_time_limit,
+                page_size=page_size,
+                log_sql_errors=log_sql_errors,
+            )
+        if not params:
+            results = await self.results_from_stats(sql)
+            if results is not None:
+                return results
+        query_cache = get_query_cache(self.ds)
+        key = None
+        if query_cache is not None:
+            key = self.query_cache_key(sql, params, truncate, page_size)
+        if key is not None:
+            results = query_cache.get(key)
+            if results is not None:
+                # A fresh rows list, in case the caller changes it
+                return Results(
+                    list(results.rows), results.truncated, results.description
+                )
+        results = await super().execute(
+            sql,
+            params,
+            truncate=truncate,
+            custom_time_limit=custom_time_limit,
+            page_size=page_size,
+            log_sql_errors=log_sql_errors,
+        )
+        if key is not None:
+            query_cache.put(key, results)
+        return results
+
+    def query_cache_key(self, sql, params, truncate, page_size):
+        if uncacheable_sql_re.search(sql):
+            return None
+        if isinstance(params, dict):
+            params = tuple(sorted(params.items()))
+        else:
+            params = tuple(params or ())
+        try:
+            hash(params)
+        except TypeError:
+            return None
+        return (self.name, self.file_stamp(), sql, params, truncate, page_size)
+
+    def file_stamp(self):
+        # Every commit, by this process or another worker sharing root_dir,
+        # changes the modification time or size of the database or its WAL
+        stamp = []
+        for path in (self.path, self.path + "-wal"):
+            try:
+                stat = pathlib.Path(path).stat()
+            except FileNotFoundError:
+                stamp.append(None)
+            else:
+                stamp.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(stamp)
+
+    async def execute_write_fn(self, fn, block=True):
+        if self._closed:
+            return await self.attached().execute_write_fn(fn, block=block)
+        query_cache = get_query_cache(self.ds)
+
+        # Busy from being queued until it has run, so it is never detached with
+        # writes still waiting. Imports, transforms and evictions all write
+        # through here, so cached results are dropped as each write is done
+        def write_then_release(conn):
+            try:
+                return fn(conn)
+            finally:
+                if query_cache is not None:
+                    query_cache.invalidate(self.name)
+                self.finished_using()
+
+        self.started_using()
+        return await super().execute_write_fn(write_then_release, block=block)
+
+    async def cached_table_names(self):
+        now = time.monotonic()
+        if self._table_names is None or (
+            now - self._schema_checked > SCHEMA_CHECK_SECONDS
+        ):
+            # Fallback for tables created or dropped by something other than imports
+            self._schema_checked = now
+            version = await self.execute_fn(
+                lambda conn: conn.execute("PRAGMA schema_version").fetchone()[0]
+            )
+            if self._table_names is None or version != self._schema_version:
+                self._table_names = set(await self.table_names())
+                self._schema_version = version
+        return self._table_names | self._importing_tables
+
+    def table_import_started(self, table):
+        self._importing_tables.add(table)
+        self.invalidate_table_validators()
+
+    def table_import_finished(self, table, exists):
+        self._importing_tables.discard(table)
+        self.invalidate_table_validators()
+        if self._table_names is not None:
+            if exists:
+                self._table_names.add(table)
+            else:
+                self._table_names.discard(table)
+
+    def record_table_access(self, table):
+        self._table_access[table] = time.time()
+
+    def save_table_access(self, conn):
+        # On the write thread - swap first, so visits during the write are kept
+        accessed, self._table_access = self._table_access, {}
+        if accessed:
+            sqlite_utils.Database(conn)["_table_access_"].upsert_all(
+                [
+                    {"table": table, "accessed": when}
+                    for table, when in accessed.items()
+                ],
+                pk="table",
+            )
+
+    async def evicted_tables(self):
+        if self._evicted_tables is None or (
+            time.monotonic() - self._evicted_tables_loaded > SCHEMA_CHECK_SECONDS
+        ):
+            self._evicted_tables = await self.execute_fn(load_evicted_tables)
+            self._evicted_tables_loaded = time.monotonic()
+        return self._evicted_tables
+
+    def invalidate_table_validators(self):
+        self._table_validators_version += 1
+        self._table_validators = None
+
+    async def table_validator(self, table):
+        "Returns (source etag, completed) for a completed table, or None"
+        if table in self._importing_tables:
+            return None
+        validators = self._table_validators
+        # Reloaded now and then, as other workers may have imported tables
+        if validators is None or (
+            time.monotonic() - self._table_validators_loaded > SCHEMA_CHECK_SECONDS
+        ):
+            version = self._table_validators_version
+            validators = await self.execute_fn(load_table_validators)
+            if version == self._table_validators_version:
+                self._table_validators = validators
+                self._table_validators_loaded = time.monotonic()
+        return validators.get(table)
+
+    async def table_stats(self):
+        if self._table_stats is not None and (
+            time.monotonic() - self._table_stats_loaded <= SCHEMA_CHECK_SECONDS
+        ):
+            return self._table_stats
+        version = self._table_stats_version
+        stats = await self.execute_fn(load_table_stats)
+        # Discard if an import changed the stats while we were reading them
+        if version == self._table_stats_version:
+            self._table_stats = stats
+            self._table_stats_loaded = time.monotonic()
+        return stats
+
+    def set_table_stats(self, table, stats):
+        # Called from the write thread once stats are saved or deleted
+        self._table_stats_version += 1
+        if self._table_stats is not None:
+            if stats is None:
+                self._table_stats.pop(table, None)
+            else:
+                self._table_stats[table] = stats
+
+    async def results_from_stats(self, sql):
+        match = count_sql_re.match(sql)
+        if match:
+            stats = (await self.table_stats()).get(unescape_name(match.group(1)))
+            if stats is None:
+                return None
+            return Results(
+                [StatsRow(("count(*)",), (stats["row_count"],))],
+                False,
+                [("count(*)",)],
+            )
+        match = suggest_facet_sql_re.match(sql)
+        if match:
+            stats = (await self.table_stats()).get(unescape_name(match.group("table")))
+            if stats is None:
+                return None
+            column = stats["columns"].get(unescape_name(match.group("column")))
+            if column is None:
+                return None
+            limit = int(match.group("limit"))
+            top_values = column["top_values"]
+            if len(top_values) < min(limit, column["distinct_values"]):
+                # Not enough stored values to answer this one
+                return None
+            return Results(
+                [StatsRow(("value", "n"), pair) for pair in top_values[:limit]],
+                False,
+                [("value",), ("n",)],
+            )
+        return None
+
+    def close(self):
+        self._closed = True
+        if self._write_thread is not None:
+            write_queue = self._write_queue
+
+            # Queued behind any pending writes: close the connection, end the
+            # thread. The write thread reads self._write_queue for every task,
+            # so it is only cleared here, on that thread
+            def stop_writing(conn):
+                self._write_thread = None
+                self._write_queue = None
+                # Anything queued while this was waiting still gets written
+                while not write_queue.empty():
+                    task = write_queue.get()
+                    try:
+                        result = task.fn(conn)
+                    except Exception as e:
+                        result = e
+                    task.reply_queue.sync_q.put(result)
+                if conn is not None:
+                    self.save_table_access(conn)
+                    conn.close()
+                raise SystemExit
+
+            write_queue.put(types.SimpleNamespace(fn=stop_writing))
+        if self._write_connection is not None:
+            self._write_connection.close()
+            self._write_connection = None
+        self._read_connection = None
+        self._thread_connections = {}
+        super().close()
+        self._all_file_connections = []
+
+
+class QueryCache:
+    """
+    Results of read queries against project databases. Least recently used
+    results are evicted once their estimated size passes max_bytes, and
+    results bigger than max_result_bytes are never cached.
+    """
+
+    def __init__(self, metrics, max_bytes, max_result_bytes):
+        self.metrics = metrics
+        self.max_bytes = max_bytes
+        self.max_result_bytes = max_result_bytes
+        # Invalidated from write threads, so guarded by a lock
+        self.lock = threading.Lock()
+        # (database, file stamp, sql, params, truncate, page_size) => (results, size)
+        self.entries = collections.OrderedDict()
+        # database => {key: None}, so a write only visits that database's keys
+        self.database_keys = {}
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None:
+            self.metrics.inc("big_local_query_cache_misses_total")
+            return None
+        self.metrics.inc("big_local_query_cache_hits_total")
+        return entry[0]
+
+    def put(self, key, results):
+        size = results_size(results.rows, self.max_result_bytes)
+        if size is None:
+            return
+        evicted = 0
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[key] = (results, size)
+            self.database_keys.setdefault(key[0], {})[key] = None
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, (_, evicted_size) = self.entries.popitem(last=False)
+                self._unindex(evicted_key)
+                self.size -= evicted_size
+                evicted += 1
+        if evicted:
+            self.metrics.inc(
+                "big_local_query_cache_evictions_total", evicted, reason="size"
+            )
+
+    def invalidate(self, database):
+        with self.lock:
+            keys = self.database_keys.pop(database, ())
+            for key in keys:
+                self.size -= self.entries.pop(key)[1]
+        if keys:
+            self.metrics.inc(
+                "big_local_query_cache_evictions_total", len(keys), reason="write"
+            )
+
+    def _unindex(self, key):
+        keys = self.database_keys[key[0]]
+        del keys[key]
+        if not keys:
+            del self.database_keys[key[0]]
+
+
+def results_size(rows, limit):
+    "Rough bytes held by rows, or None as soon as that is over limit"
+    size = 0
+    for row in rows:
+        size += 64
+        for value in row:
+            if isinstance(value, (str, bytes)):
+                size += 49 + len(value)
+            else:
+                size += 24
+        if size > limit:
+            return None
+    return size
+
+
+def get_query_cache(datasette):
+    "The query result cache, or None if query_cache_mb is not set"
+    settings = get_settings(datasette)
+    if not settings.query_cache_mb:
+        return None
+    query_cache = getattr(datasette, "big_local_query_cache", None)
+    if query_cache is None:
+        query_cache = QueryCache(
+            get_metrics(datasette),
+            settings.query_cache_mb * 1024 * 1024,
+            settings.query_cache_max_result_kb * 1024,
+        )
+        datasette.big_local_query_cache = query_cache
+    return query_cache
+
+
+def unescape_name(name):
+    return name[1:-1] if name.startswith("[") else name
+
+
+def load_table_stats(conn):
+    database = sqlite_utils.Database(conn)
+    if not database["_table_stats_"].exists():
+        return {}
+    stats = {
+        row["table"]: {"row_count": row["row_count"], "columns": {}}
+        for row in database["_table_stats_"].rows
+    }
+    for row in database["_column_stats_"].rows:
+        if row["table"] in stats:
+            row["distinct_exact"] = bool(row["distinct_exact"])
+            row["top_values"] = json.loads(row["top_values"])
+            stats[row.pop("table")]["columns"][row.pop("column")] = row
+    return stats
+
+
+def save_table_stats(conn, table_name, stats):
+    database = sqlite_utils.Database(conn)
+    if not database["_table_stats_"].exists():
+        database["_table_stats_"].create(
+            {"table": str, "row_count": int, "computed": str}, pk="table"
+        )
+        database["_column_stats_"].create(
+            {
+                "table": str,
+                "column": str,
+                "type": str,
+                "distinct_values": int,
+                "distinct_exact": int,
+                "null_count": int,
+                "min": str,
+                "max": str,
+                "top_values": str,
+            },
+            pk=("table", "column"),
+        )
+    with conn:
+        delete_table_stats(conn, table_name)
+        database["_table_stats_"].insert(
+            {
+                "table": table_name,
+                "row_count": stats["row_count"],
+                "computed": str(datetime.datetime.utcnow()),
+            }
+        )
+        database["_column_stats_"].insert_all(
+            dict(
+                column_stats,
+                table=table_name,
+                column=column,
+                top_values=json.dumps(column_stats["top_values"]),
+            )
+            for column, column_stats in stats["columns"].items()
+        )
+
+
+def delete_table_stats(conn, table_name):
+    database = sqlite_utils.Database(conn)
+    if database["_table_stats_"].exists():
+        database["_table_stats_"].delete_where("[table] = ?", [table_name])
+        database["_column_stats_"].delete_where("[table] = ?", [table_name])
+
+
+def load_evicted_tables(conn):
+    database = sqlite_utils.Database(conn)
+    if not database["_evicted_tables_"].exists():
+        return {}
+    return {row["table"]: row for row in database["_evicted_tables_"].rows}
+
+
+def load_table_access(conn):
+    "Returns {table: last accessed} for imported tables that are not importing"
+    database = sqlite_utils.Database(conn)
+    if not database["_import_progress_"].exists():
+        return {}
+    accessed = {}
+    if database["_table_access_"].exists():
+        accessed = dict(conn.execute("select [table], accessed from _table_access_"))
+    existing = set(database.table_names())
+    last_access = {}
+    for table, completed, unfinished in conn.execute(
+        "select [table], max(completed), count(*) - count(completed)"
+        " from _import_progress_ group by [table]"
+    ):
+        if unfinished or table not in existing:
+            continue
+        # Tables nobody has visited since they were imported count from then
+        imported = (
+            datetime.datetime.fromisoformat(completed)
+            .replace(tzinfo=datetime.timezone.utc)
+            .timestamp()
+        )
+        last_access[table] = max(accessed.get(table) or 0, imported)
+    return last_access
+
+
+def evict_table(conn, table_name):
+    # Drop an imported table and everything derived from it, remembering where
+    # it came from so it can be imported again when it is next visited
+    database = sqlite_utils.Database(conn)
+    source_etag = None
+    size = None
+    columns = database["_import_progress_"].columns_dict
+    if columns:
+        import_rows = "[table] = ? and " + import_stage_sql(conn)
+        if "source_etag" in columns:
+            latest = conn.execute(
+                "select source_etag from _import_progress_ where {}"
+                " order by started desc limit 1".format(import_rows),
+                [table_name],
+            ).fetchall()
+            if latest:
+                source_etag = latest[0][0]
+        size = conn.execute(
+            "select sum(bytes_done) from _import_progress_ where {}".format(
+                import_rows
+            ),
+            [table_name],
+        ).fetchall()[0][0]
+    for name in ("{}_fts".format(table_name), table_name):
+        if database[name].exists():
+            database[name].drop()
+    delete_table_stats(conn, table_name)
+    for side_table in ("_import_progress_", "_import_indexes_", "_table_access_"):
+        if database[side_table].exists():
+            database[side_table].delete_where("[table] = ?", [table_name])
+    database["_evicted_tables_"].upsert(
+        {
+            "table": table_name,
+            "filename": alnum_decode(table_name),
+            "source_etag": source_etag,
+            "bytes": size,
+            "evicted": str(datetime.datetime.utcnow()),
+        },
+        pk="table",
+    )
+    conn.commit()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        # execute() only steps this once, freeing a single page - executescript()
+        # runs it to completion
+        conn.executescript("PRAGMA incremental_vacuum")
+    else:
+        # Files created before auto_vacuum was set need one full VACUUM first
+        set_pragma(conn, "auto_vacuum", "incremental")
+        conn.execute("VACUUM")
+    # Shrink the WAL too, or the space would not be returned until later
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+
+def database_size(db_path):
+    db_path = pathlib.Path(db_path)
+    wal_path = db_path.with_name(db_path.name + "-wal")
+    return sum(path.stat().st_size for path in (db_path, wal_path) if path.exists())
+
+
+def exceeds_disk_limits(datasette, project_uuid, extra_bytes=0):
+    "Would adding extra_bytes to this project take it past either disk limit?"
+    settings = get_settings(datasette)
+    budget = settings.disk_budget_mb * 1024 * 1024
+    quota = settings.project_quota_mb * 1024 * 1024
+    if not budget and not quota:
+        return False
+    sizes = {
+        path.stem: database_size(path)
+        for path in pathlib.Path(settings.root_dir).glob("*.db")
+        if database_path_re.match("/" + path.stem)
+    }
+    if quota and sizes.get(project_uuid, 0) + extra_bytes > quota:
+        return True
+    return bool(budget) and sum(sizes.values()) + extra_bytes > budget
+
+
+def read_detached_database(db_path, fn):
+    conn = sqlite3.connect("file:{}?mode=ro".format(db_path), uri=True)
+    try:
+        return fn(conn)
+    finally:
+        conn.close()
+
+
+def get_disk_quota_lock(datasette):
+    lock = getattr(datasette, "big_local_disk_quota_lock", None)
+    if lock is None:
+        datasette.big_local_disk_quota_lock = lock = asyncio.Lock()
+    return lock
+
+
+async def enforce_disk_quotas(datasette, keep=None):
+    """
+    Drop the least recently accessed imported tables until every project is
+    within project_quota_mb and root_dir as a whole is within disk_budget_mb.
+
+    keep is a (database, table) pair that should never be dropped, such as a
+    table that has just been imported.
+    """
+    settings = get_settings(datasette)
+    budget = settings.disk_budget_mb * 1024 * 1024
+    quota = settings.project_quota_mb * 1024 * 1024
+    if not budget and not quota:
+        return []
+    evicted = []
+    loop = asyncio.get_event_loop()
+    async with get_disk_quota_lock(datasette):
+        root_dir = pathlib.Path(settings.root_dir)
+        for db in list(datasette.databases.values()):
+            if isinstance(db, ProjectDatabase) and db._table_access:
+                await db.execute_write_fn(db.save_table_access)
+        while True:
+            sizes = {
+                path.stem: database_size(path)
+                for path in root_dir.glob("*.db")
+                if database_path_re.match("/" + path.stem)
+            }
+            over_quota = [
+                project_uuid
+                for project_uuid, size in sizes.items()
+                if quota and size > quota
+            ]
+            if over_quota:
+                projects = over_quota
+            elif budget and sum(sizes.values()) > budget:
+                projects = list(sizes)
+            else:
+                break
+            candidates = []
+            for project_uuid in projects:
+                db = datasette.databases.get(project_uuid)
+                if isinstance(db, ProjectDatabase):
+                    last_access = await db.execute_fn(load_table_access)
+                    importing = db._importing_tables
+                else:
+                    last_access = await loop.run_in_executor(
+                        None,
+                        read_detached_database,
+                        root_dir / "{}.db".format(project_uuid),
+                        load_table_access,
+                    )
+                    importing = set()
+                candidates.extend(
+                    (accessed, project_uuid, table)
+                    for table, accessed in last_access.items()
+                    if table not in importing and (project_uuid, table) != keep
+                )
+            if not candidates:
+                break
+            accessed, project_uuid, table = min(candidates)
+            db = ensure_database(datasette, project_uuid)
+
+            def evict(conn):
+                evict_table(conn, table)
+                db.set_table_stats(table, None)
+                db.table_import_finished(table, exists=False)
+                db._evicted_tables = None
+
+            await db.execute_write_fn(evict)
+            get_metrics(datasette).inc("big_local_evicted_tables_total")
+            evicted.append((project_uuid, table))
+    return evicted
+
+
+async def reimport_evicted_table(datasette, scope, receive, database, table):
+    # Import a table that was dropped to save space again, as it is visited
+    db = datasette.databases.get(database)
+    if not isinstance(db, ProjectDatabase):
+        return
+    evicted = (await db.evicted_tables()).get(table)
+    if evicted is None or table in db._importing_tables:
+        return
+    actor = actor_from_scope(datasette, scope, receive)
+    if not actor or not actor.get("token"):
+        return
+    try:
+        # This also confirms the user can still access the project
+        uri, etag, length = await open_project_file(
+            datasette, project_uuid_to_id(database), evicted["filename"], actor["token"]
+        )
+    except (OpenError, BigLocalUnavailable, httpx.HTTPError):
+        return
+    if table in db._importing_tables:
+        return
+    if await import_file(db, uri, table, etag=etag):
+        get_metrics(datasette).inc("big_local_reimports_total")
+        # Give it a moment to create the table and start running
+        await asyncio.sleep(0.5)
+    else:
+        await follow_import(db, table)
+
+
+class OpenDatabases:
+    "Project databases attached to Datasette, least recently used first"
+
+    def __init__(self):
+        self.last_used = collections.OrderedDict()
+        self.pins = collections.Counter()
+        self.lock = threading.Lock()
+
+
+def get_open_databases(datasette):
+    open_databases = getattr(datasette, "big_local_open_databases", None)
+    if open_databases is None:
+        datasette.big_local_open_databases = open_databases = OpenDatabases()
+    return open_databases
+
+
+def touch_database(datasette, project_uuid):
+    open_databases = get_open_databases(datasette)
+    with open_databases.lock:
+        open_databases.last_used[project_uuid] = True
+        open_databases.last_used.move_to_end(project_uuid)
+
+
+def pin_database(datasette, project_uuid):
+    # Pinned databases are never evicted - used by running imports
+    open_databases = get_open_databases(datasette)
+    with open_databases.lock:
+        open_databases.pins[project_uuid] += 1
+
+
+def unpin_database(datasette, project_uuid):
+    open_databases = get_open_databases(datasette)
+    with open_databases.lock:
+        open_databases.pins[project_uuid] -= 1
+        if open_databases.pins[project_uuid] <= 0:
+            del open_databases.pins[project_uuid]
+
+
+def evict_idle_databases(datasette):
+    max_open = get_settings(datasette).max_open_databases
+    open_databases = get_open_databases(datasette)
+    evicted = []
+    with open_databases.lock:
+        # Forget about anything that was removed by something else
+        for name in list(open_databases.last_used):
+            if not isinstance(datasette.databases.get(name), ProjectDatabase):
+                del open_databases.last_used[name]
+        excess = len(open_databases.last_used) - max_open
+        # Never evict the most recently used database, it was just asked for
+        for name in list(open_databases.last_used)[:-1]:
+            if excess <= 0:
+                break
+            db = datasette.databases[name]
+            if open_databases.pins.get(name) or db.is_busy:
+                continue
+            del open_databases.last_used[name]
+            evicted.append(db)
+            excess -= 1
+    for db in evicted:
+        datasette.remove_database(db.name)
+        db.close()
+    return [db.name for db in evicted]
+
+
+def create_database_file(datasette, db_path):
+    settings = get_settings(datasette)
+    database = sqlite_utils.Database(str(db_path))
+    # page_size only takes effect before the first write, or on VACUUM
+    set_pragma(database.conn, "page_size", int(settings.sqlite_page_size))
+    # So space freed by evicting tables can be returned a little at a time
+    set_pragma(database.conn, "auto_vacuum", "incremental")
+    database.vacuum()
+    set_pragma(database.conn, "journal_mode", settings.sqlite_journal_mode)
+    database.close()
+
+
 def ensure_database(datasette, project_uuid):
     # Create a database of that name if one does not exist already
     try:
         db = datasette.get_database(project_uuid)
     except KeyError:
         root_dir = pathlib.Path(get_settings(datasette).root_dir)
-        # Create empty file
-        db_path = str(root_dir / "{}.db".format(project_uuid))
-        sqlite_utils.Database(db_path).vacuum()
-        db = datasette.add_database(Database(datasette, path=db_path, is_mutable=True))
+        db_path = root_dir / "{}.db".format(project_uuid)
+        if not db_path.exists():
+            create_database_file(datasette, db_path)
+        db = datasette.add_database(
+            ProjectDatabase(datasette, path=str(db_path), is_mutable=True),
+            name=project_uuid,
+        )
+    if isinstance(db, ProjectDatabase):
+        touch_database(datasette, project_uuid)
+        evict_idle_databases(datasette)
     return db
 
 
+def reattach_database(datasette, project_uuid):
+    # Attach a previously evicted (or not yet opened) database from root_dir
+    if project_uuid in datasette.databases:
+        return ensure_database(datasette, project_uuid)
+    db_path = pathlib.Path(get_settings(datasette).root_dir) / "{}.db".format(
+        project_uuid
+    )
+    if db_path.exists():
+        return ensure_database(datasette, project_uuid)
+    return None
+
+
+def unavailable_response(datasette):
+    # Retry-After matches how often the circuit breaker probes for recovery
+    response = Response.html(
+        "<h1>Big Local is not responding, please try again shortly</h1>", status=503
+    )
+    response.headers["Retry-After"] = str(
+        get_settings(datasette).circuit_breaker_probe_seconds
+    )
+    return response
+
+
 async def big_local_open_private(request, datasette):
     # Same as big_local_open but reads remember_token from a cookie
     if not request.actor or not request.actor.get("token"):
@@ -298,6 +1878,15 @@ async def big_local_open_implementation(request, datasette, remember_token=None)
     project_id = post["project_id"]
     remember_token = remember_token or post["remember_token"]
 
+    reader = reader_for_filename(filename)
+    if reader is not None and not reader.available():
+        return Response.html(
+            "Opening {} requires {} to be installed".format(
+                html.escape(filename), reader.requires
+            ),
+            status=400,
+        )
+
     # Turn project ID into a UUID
     project_uuid = project_id_to_uuid(project_id)
 
@@ -312,6 +1901,8 @@ async def big_local_open_implementation(request, datasette, remember_token=None)
         return Response.html(
             "Could not open file: {}".format(html.escape(str(e))), status=400
         )
+    except BigLocalUnavailable:
+        return unavailable_response(datasette)
 
     csv_size_limit_mb = get_settings(datasette).csv_size_limit_mb
     if length > csv_size_limit_mb * 1024 * 1024:
@@ -322,10 +1913,25 @@ async def big_local_open_implementation(request, datasette, remember_token=None)
     # uri is valid, do we have the table already?
     table_name = alnum_encode(filename)
 
-    if not await db.table_exists(table_name):
-        await import_csv(db, uri, table_name)
-        # Give it a moment to create the progress table and start running
-        await asyncio.sleep(0.5)
+    # A background prefetch of this file becomes the import the user is waiting on
+    prefetching = get_prefetcher(datasette).claim((project_uuid, table_name))
+
+    if prefetching:
+        # It may not have created the table yet - wait as for another worker
+        await follow_import(db, table_name)
+    elif await table_needs_import(db, table_name):
+        # Admins can ask for a stack profile of the import
+        profile = bool(post.get("_big_local_profile")) and (
+            await datasette.permission_allowed(
+                request.actor, "big-local-admin", default=False
+            )
+        )
+        if await import_file(db, uri, table_name, profile=profile, etag=etag):
+            # Give it a moment to create the progress table and start running
+            await asyncio.sleep(0.5)
+        else:
+            # Another worker got there first - send the user to its progress
+            await follow_import(db, table_name)
 
     response = Response.redirect("/{}/{}".format(project_uuid, table_name))
 
@@ -335,7 +1941,10 @@ async def big_local_open_implementation(request, datasette, remember_token=None)
         pass
     else:
         # Look up user and set cookie
-        actor = await get_big_local_user(datasette, remember_token)
+        try:
+            actor = await get_big_local_user(datasette, remember_token)
+        except BigLocalUnavailable:
+            return unavailable_response(datasette)
         if not actor:
             return Response.html("Invalid token", status=400)
         # Rename displayName to display
@@ -350,7 +1959,6 @@ async def big_local_open_implementation(request, datasette, remember_token=None)
 
 
 async def get_big_local_user(datasette, remember_token):
-    graphql_endpoint = get_settings(datasette).graphql_url
     query = """
     query {
         user {
@@ -362,11 +1970,8 @@ async def get_big_local_user(datasette, remember_token):
     }
     """.strip()
     async with httpx.AsyncClient() as client:
-        response = await client.post(
-            graphql_endpoint,
-            json={"query": query},
-            cookies={"remember_token": remember_token},
-            timeout=30,
+        response = await graphql_request(
+            datasette, client, "get_big_local_user", {"query": query}, remember_token
         )
     if response.status_code != 200:
         return None
@@ -406,7 +2011,10 @@ async def big_local_project(datasette, request):
         actor = request.actor
     else:
         # Check remember_token is for a valid actor
-        actor = await get_big_local_user(datasette, remember_token)
+        try:
+            actor = await get_big_local_user(datasette, remember_token)
+        except BigLocalUnavailable:
+            return unavailable_response(datasette)
         if not actor:
             return Response.html("<h1>Invalid token</h1>", status=403)
         actor["display"] = actor.pop("displayName")
@@ -418,14 +2026,14 @@ async def big_local_project(datasette, request):
         project = await get_project(datasette, project_id, actor["token"], True)
     except (ProjectPermissionError, ProjectNotFoundError):
         return Response.html("<h1>Cannot access project</h1>", status=403)
+    except BigLocalUnavailable:
+        return unavailable_response(datasette)
 
     # Figure out UUID for project
     project_uuid = project_id_to_uuid(project_id)
 
-    # Stash project files in the cache
-    cache = get_cache(datasette)
-    cache_key = "project-files-{}".format(project_id)
-    cache[cache_key] = project["files"]
+    # Stash project files, to be listed on the database page
+    store_project_files(datasette, project_id, project["files"], actor["token"])
 
     # Ensure database for project exists
     ensure_database(datasette, project_uuid)
@@ -440,185 +2048,1957 @@ async def big_local_project(datasette, request):
     return response
 
 
+async def big_local_import_project(request, datasette):
+    """
+    Import every eligible file in a project, or just the filename POST
+    variables, with bulk_import_concurrency imports running at a time
+    """
+    if request.method != "POST":
+        return Response.text("POST required", status=405)
+    if not request.actor or not request.actor.get("token"):
+        return Response.text("Forbidden", status=403)
+    remember_token = request.actor["token"]
+    # post_vars() would only keep one of the repeated filename variables
+    post = parse_qs((await request.post_body()).decode("utf-8"))
+    project_id = (post.get("project_id") or [None])[0]
+    if not project_id:
+        return Response.html("project_id POST variable is required", status=400)
+    project_uuid = project_id_to_uuid(project_id)
+    # The cached listing may have been fetched with someone else's token
+    if not await datasette.permission_allowed(
+        request.actor, "view-database", project_uuid, default=False
+    ):
+        return Response.html("<h1>Cannot access project</h1>", status=403)
+    files = cached_project_files(datasette, project_id)
+    if files is None:
+        try:
+            project = await get_project(datasette, project_id, remember_token, True)
+        except (ProjectPermissionError, ProjectNotFoundError):
+            return Response.html("<h1>Cannot access project</h1>", status=403)
+        except BigLocalUnavailable:
+            return unavailable_response(datasette)
+        store_project_files(datasette, project_id, project["files"], remember_token)
+        files = project["files"]
+
+    db = ensure_database(datasette, project_uuid)
+    table_names = await db.cached_table_names()
+    selected = set(post.get("filename") or [])
+    size_limit = get_settings(datasette).csv_size_limit_mb * 1024 * 1024
+    bulk_imports = get_bulk_imports(datasette)
+    previous = bulk_imports.get(project_uuid)
+    running = set(previous.files) if previous and not previous.done else set()
+    filenames = [
+        file["name"]
+        for file in files
+        if (not selected or file["name"] in selected)
+        and importable(file["name"])
+        and file["size"] < size_limit
+        and file["table_name"] not in running
+        and (
+            file["table_name"] not in table_names
+            or await table_needs_import(db, file["table_name"])
+        )
+    ]
+    if filenames:
+        bulk_import = BulkImport(filenames)
+        if running:
+            # Keep showing the files an earlier request is still importing
+            bulk_import.files = collections.OrderedDict(
+                list(previous.files.items()) + list(bulk_import.files.items())
+            )
+        bulk_imports[project_uuid] = bulk_import
+        # Kept attached while files wait their turn, unpinned when all are done
+        pin_database(datasette, project_uuid)
+        asyncio.ensure_future(
+            run_bulk_import(datasette, db, project_id, filenames, remember_token)
+        )
+    return Response.redirect("/{}".format(project_uuid))
+
+
 @hookimpl
 def extra_template_vars(datasette, view_name, database):
     async def inner():
         if view_name != "database":
             return {}
-        cache = get_cache(datasette)
-        cache_key = "project-files-{}".format(project_uuid_to_id(database))
-        files = cache.get(cache_key) or []
-        if not files:
-            return {}
-        # Filter out just the CSVs that have not yet been imported
         db = datasette.get_database(database)
-        table_names = set(await db.table_names())
+        bulk_import = get_bulk_imports(datasette).get(database)
+        extra = {}
+        if bulk_import is not None:
+            extra = {
+                "bulk_import": await bulk_import.progress(db),
+                "bulk_import_running": not bulk_import.done,
+            }
+        files = cached_project_files(datasette, project_uuid_to_id(database))
+        if not files:
+            return extra
+        # Filter out just the files we can import that have not yet been imported
+        if isinstance(db, ProjectDatabase):
+            table_names = await db.cached_table_names()
+        else:
+            table_names = set(await db.table_names())
+        if bulk_import is not None and not bulk_import.done:
+            table_names = table_names | set(bulk_import.files)
         available_files = [
             file
             for file in files
-            if file["name"].endswith(".csv")
-            and alnum_encode(file["name"]) not in table_names
+            if importable(file["name"])
+            and file["table_name"] not in table_names
             and file["size"] < get_settings(datasette).csv_size_limit_mb * 1024 * 1024
         ]
-        return {
-            "available_files": available_files,
-            "project_id": project_uuid_to_id(database),
-        }
+        return dict(
+            extra,
+            available_files=available_files,
+            project_id=project_uuid_to_id(database),
+        )
 
     return inner
 
 
+async def big_local_metrics(request, datasette):
+    if not await datasette.permission_allowed(
+        request.actor, "big-local-admin", default=False
+    ):
+        return Response.text("Forbidden", status=403)
+    open_databases = get_open_databases(datasette)
+    query_cache = get_query_cache(datasette)
+    project_databases = [
+        db for db in datasette.databases.values() if isinstance(db, ProjectDatabase)
+    ]
+    # Gauges are read at scrape time, so they cost nothing on the hot paths
+    gauges = {
+        ("big_local_active_imports", ()): sum(open_databases.pins.values()),
+        ("big_local_open_databases", ()): len(project_databases),
+        ("big_local_write_queue_depth", ()): sum(
+            db._write_queue.qsize()
+            for db in project_databases
+            if db._write_queue is not None
+        ),
+        ("big_local_cache_size", ()): len(get_cache(datasette)),
+        ("big_local_query_cache_bytes", ()): query_cache.size if query_cache else 0,
+        ("big_local_circuit_open", ()): int(
+            get_circuit_breaker(datasette).state == "open"
+        ),
+    }
+    return Response(
+        get_metrics(datasette).render(gauges),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+async def big_local_circuit(request, datasette):
+    if not await datasette.permission_allowed(
+        request.actor, "big-local-admin", default=False
+    ):
+        return Response.text("Forbidden", status=403)
+    settings = get_settings(datasette)
+    return Response.json(
+        dict(
+            get_circuit_breaker(datasette).summary(),
+            probe_seconds=settings.circuit_breaker_probe_seconds,
+            timeouts=settings.graphql_timeouts,
+        )
+    )
+
+
+async def big_local_profiles(request, datasette):
+    if not await datasette.permission_allowed(
+        request.actor, "big-local-admin", default=False
+    ):
+        return Response.text("Forbidden", status=403)
+    profiles = get_profiles(datasette)
+    profile_id = request.url_vars.get("profile_id")
+    if profile_id is None:
+        return Response.json(
+            [profile.summary() for profile in reversed(profiles.values())]
+        )
+    if profile_id not in profiles:
+        return Response.text("Profile not found", status=404)
+    # Collapsed stacks, ready for flamegraph.pl or speedscope
+    return Response.text(profiles[profile_id].collapsed())
+
+
 @hookimpl
 def register_routes():
     return [
         (r"^/-/big-local-open$", big_local_open),
         (r"^/-/big-local-open-private$", big_local_open_private),
         (r"^/-/big-local-project$", big_local_project),
+        (r"^/-/big-local-import-project$", big_local_import_project),
+        (r"^/-/big-local-metrics$", big_local_metrics),
+        (r"^/-/big-local-circuit$", big_local_circuit),
+        (r"^/-/big-local-profiles$", big_local_profiles),
+        (r"^/-/big-local-profiles/(?P<profile_id>\w+)$", big_local_profiles),
     ]
 
 
+@hookimpl
+def asgi_wrapper(datasette):
+    def wrap_with_reattach(app):
+        async def reattach_then_serve(scope, receive, send):
+            db = None
+            if scope["type"] == "http":
+                match = database_path_re.match(scope["path"])
+                if match:
+                    # Transparently re-attach project databases that were evicted
+                    db = reattach_database(datasette, match.group(1))
+            if not isinstance(db, ProjectDatabase):
+                await serve(scope, receive, send)
+                return
+            # Busy for the whole request, so it is not detached between queries
+            db.started_using()
+            try:
+                await serve(scope, receive, send)
+            finally:
+                db.finished_using()
+
+        async def serve(scope, receive, send):
+            if scope["type"] == "http":
+                if b"_big_local_profile=1" in scope.get("query_string", b""):
+                    await profile_request(datasette, app, scope, receive, send)
+                    return
+                match = table_path_re.match(scope["path"])
+                if match and scope["method"] in ("GET", "HEAD"):
+                    db = datasette.databases.get(match.group(1))
+                    if isinstance(db, ProjectDatabase):
+                        db.record_table_access(match.group(2))
+                    await reimport_evicted_table(
+                        datasette, scope, receive, *match.groups()
+                    )
+                    await serve_with_etag(
+                        datasette, app, scope, receive, send, *match.groups()
+                    )
+                    return
+            await app(scope, receive, send)
+
+        return reattach_then_serve
+
+    return wrap_with_reattach
+
+
+def actor_from_scope(datasette, scope, receive):
+    # ASGI wrappers run before Datasette has resolved the actor from its cookie
+    cookies = Request(scope, receive).cookies
+    if "ds_actor" in cookies:
+        try:
+            return datasette.unsign(cookies["ds_actor"], "actor")["a"]
+        except BadSignature:
+            pass
+    return None
+
+
+async def profile_request(datasette, app, scope, receive, send):
+    # Only admins can profile requests
+    actor = actor_from_scope(datasette, scope, receive)
+    if not await datasette.permission_allowed(actor, "big-local-admin", default=False):
+        await app(scope, receive, send)
+        return
+    loop_thread = threading.get_ident()
+    executor = datasette.executor
+    sampler = start_profile(
+        datasette,
+        "request {}".format(scope["path"]),
+        # The event loop plus the threads that run SQL queries
+        lambda: [loop_thread]
+        + [t.ident for t in (executor._threads if executor else ())],
+    )
+
+    async def send_with_profile_id(event):
+        if event["type"] == "http.response.start":
+            event = dict(
+                event,
+                headers=list(event.get("headers") or [])
+                + [[b"x-big-local-profile", sampler.id.encode("utf-8")]],
+            )
+        await send(event)
+
+    try:
+        await app(scope, receive, send_with_profile_id)
+    finally:
+        sampler.stop()
+
+
+async def serve_with_etag(datasette, app, scope, receive, send, database, table):
+    db = datasette.databases.get(database)
+    validator = None
+    if isinstance(db, ProjectDatabase):
+        version = db._table_validators_version
+        validator = await db.table_validator(table)
+    if validator is None:
+        await app(scope, receive, send)
+        return
+    actor = actor_from_scope(datasette, scope, receive)
+    # Pages include the signed in user, so each user gets their own validator
+    etag = 'W/"{}"'.format(
+        hashlib.sha1(
+            json.dumps(list(validator) + [actor and actor.get("id")]).encode("utf-8")
+        ).hexdigest()[:24]
+    )
+    cache_headers = [
+        [b"etag", etag.encode("utf-8")],
+        [b"cache-control", b"private, no-cache"],
+    ]
+    if_none_match = dict(scope.get("headers") or []).get(b"if-none-match", b"")
+    if (
+        etag in [tag.strip() for tag in if_none_match.decode("latin-1").split(",")]
+        # A 304 still needs the same permission checks as the page itself
+        and await datasette.permission_allowed(actor, "view-instance", default=True)
+        and await datasette.permission_allowed(
+            actor, "view-database", database, default=True
+        )
+        and await datasette.permission_allowed(
+            actor, "view-table", (database, table), default=True
+        )
+    ):
+        get_metrics(datasette).inc("big_local_not_modified_total")
+        await send(
+            {"type": "http.response.start", "status": 304, "headers": cache_headers}
+        )
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    async def send_with_etag(event):
+        if (
+            event["type"] == "http.response.start"
+            and event["status"] == 200
+            # Not if an import of this table started while the page was rendering
+            and db._table_validators_version == version
+        ):
+            event = dict(
+                event,
+                headers=[
+                    [key, value]
+                    for key, value in event.get("headers") or []
+                    if key.lower() not in (b"etag", b"cache-control")
+                ]
+                + cache_headers,
+            )
+        await send(event)
+
+    await app(scope, receive, send_with_etag)
+
+
 @hookimpl
 def skip_csrf(scope):
     return scope["path"] in ("/-/big-local-open", "/-/big-local-project")
 
 
-async def import_csv(db, url, table_name):
+def migrate_import_progress(conn):
+    # Tables created by older versions have no stage or source_etag column.
+    # Every row they hold is an import
+    database = sqlite_utils.Database(conn)
+    progress = database["_import_progress_"]
+    if not progress.exists():
+        return
+    columns = progress.columns_dict
+    if "stage" not in columns:
+        progress.add_column("stage", str)
+        conn.execute("update _import_progress_ set stage = 'import'")
+    if "source_etag" not in columns:
+        progress.add_column("source_etag", str)
+    conn.commit()
+
+
+def finish_stage_id(task_id):
+    return "{}-finish".format(task_id)
+
+
+def insert_progress_record(conn, task_id, table_name, stage, source_etag=None):
+    database = sqlite_utils.Database(conn)
+    if "_import_progress_" not in database.table_names():
+        database["_import_progress_"].create(
+            {
+                "id": str,
+                "table": str,
+                "stage": str,
+                "bytes_todo": int,
+                "bytes_done": int,
+                "rows_done": int,
+                "started": str,
+                "completed": str,
+                "source_etag": str,
+            },
+            pk="id",
+        )
+    database["_import_progress_"].insert(
+        {
+            "id": task_id,
+            "table": table_name,
+            "stage": stage,
+            "bytes_todo": None,
+            "bytes_done": 0,
+            "rows_done": 0,
+            "started": str(datetime.datetime.utcnow()),
+            "completed": None,
+            "source_etag": source_etag,
+        },
+    )
+
+
+def load_table_validators(conn):
+    database = sqlite_utils.Database(conn)
+    progress = database["_import_progress_"]
+    if not progress.exists() or "source_etag" not in progress.columns_dict:
+        return {}
+    existing = set(database.table_names())
+    # Tables with any unfinished stage, including abandoned imports, are left out
+    return {
+        table: (source_etag, completed)
+        for table, source_etag, completed, unfinished in conn.execute(
+            """
+            select
+              "table",
+              (
+                select source_etag from _import_progress_ latest
+                where latest."table" = _import_progress_."table"
+                and stage = 'import' order by started desc limit 1
+              ),
+              max(completed),
+              count(*) - count(completed)
+            from _import_progress_ group by "table"
+            """
+        )
+        if not unfinished and table in existing
+    }
+
+
+class ImportTrace:
+    """
+    Wall-clock seconds, rows and bytes for each phase of an import.
+
+    Phases on the import thread nest, and each is only charged for its own
+    time. Phases that run on the write thread are recorded with record().
+    """
+
+    def __init__(self):
+        self.seconds = collections.Counter()
+        self.rows = collections.Counter()
+        self.bytes = collections.Counter()
+        self.stack = []
+        self.last = None
+        self.saved = 0
+
+    def _switch(self):
+        now = time.perf_counter()
+        if self.stack:
+            self.seconds[self.stack[-1]] += now - self.last
+        self.last = now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self._switch()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self._switch()
+            self.stack.pop()
+
+    def timed(self, iterable, name):
+        "Charge time spent fetching each item from iterable to phase name"
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record(self, name, seconds=0, rows=0, bytes=0):
+        self.seconds[name] += seconds
+        self.rows[name] += rows
+        self.bytes[name] += bytes
+
+    def snapshot(self):
+        # list() of a dict's items is atomic, so this is safe from other threads
+        seconds, rows, bytes = (
+            list(self.seconds.items()),
+            dict(list(self.rows.items())),
+            dict(list(self.bytes.items())),
+        )
+        return [
+            {
+                "phase": name,
+                "seconds": round(value, 6),
+                "rows": rows.get(name, 0),
+                "bytes": bytes.get(name, 0),
+            }
+            for name, value in seconds
+        ]
+
+
+def save_import_trace(conn, task_id, table_name, trace):
+    sqlite_utils.Database(conn)["_import_trace_"].upsert_all(
+        (dict(row, import_id=task_id, table=table_name) for row in trace.snapshot()),
+        pk=("import_id", "phase"),
+        column_order=("import_id", "table", "phase"),
+    )
+
+
+class StackSampler:
+    """
+    Samples the wall-clock stacks of some threads every interval seconds, in
+    a background thread, counting them in flame graph "collapsed" format.
+    """
+
+    def __init__(self, name, thread_ids, interval=0.005):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        # Callable returning the idents of the threads to sample right now
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.started = str(datetime.datetime.utcnow())
+        self.finished = None
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.finished = str(datetime.datetime.utcnow())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident in self.thread_ids():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        "{} ({}:{})".format(
+                            code.co_name,
+                            pathlib.Path(code.co_filename).name,
+                            code.co_firstlineno,
+                        )
+                    )
+                    frame = frame.f_back
+                if stack:
+                    self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "started": self.started,
+            "finished": self.finished,
+            "samples": self.samples,
+            "interval": self.interval,
+        }
+
+    def collapsed(self):
+        return "".join(
+            "{} {}\n".format(stack, count) for stack, count in self.counts.most_common()
+        )
+
+
+def get_profiles(datasette):
+    profiles = getattr(datasette, "big_local_profiles", None)
+    if profiles is None:
+        datasette.big_local_profiles = profiles = collections.OrderedDict()
+    return profiles
+
+
+def start_profile(datasette, name, thread_ids):
+    profiles = get_profiles(datasette)
+    sampler = StackSampler(name, thread_ids).start()
+    profiles[sampler.id] = sampler
+    # Keep the most recent ones
+    while len(profiles) > MAX_PROFILES:
+        profiles.popitem(last=False)
+    return sampler
+
+
+MAX_PROFILES = 20
+
+
+class ImportCancelled(Exception):
+    pass
+
+
+class PrefetchImport:
+    def __init__(self, key, job):
+        self.key = key
+        # (project_id, filename, remember_token)
+        self.job = job
+        self.cancelled = threading.Event()
+        # Set once someone has asked for this table, so it is never cancelled
+        self.claimed = False
+        # Set if the import stopped and threw its rows away
+        self.discarded = False
+        self.finished = asyncio.Event()
+
+    def is_cancelled(self):
+        # A claim can land after cancel was asked for but before the import
+        # thread noticed - the user's import wins
+        return self.cancelled.is_set() and not self.claimed
+
+
+class Prefetcher:
+    """
+    Imports small CSV files in the background, one at a time, before anyone
+    asks for them.
+
+    Interactive imports always come first: prefetching waits until none are
+    running, and a running prefetch is cancelled as soon as one starts, to be
+    tried again once it is finished.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (project_uuid, table_name) => (project_id, filename, remember_token)
+        self.queue = collections.OrderedDict()
+        self.attempts = collections.Counter()
+        self.interactive = 0
+        self.running = None
+        self.worker = None
+
+    def interactive_started(self):
+        with self.lock:
+            self.interactive += 1
+            running = self.running
+            if running is not None and not running.claimed:
+                running.cancelled.set()
+
+    def interactive_finished(self):
+        with self.lock:
+            self.interactive -= 1
+
+    def claim(self, key):
+        "Called when a user opens a file: returns True if it is being prefetched"
+        with self.lock:
+            self.queue.pop(key, None)
+            running = self.running
+            if running is not None and running.key == key:
+                running.claimed = True
+                running.cancelled.clear()
+                return True
+        return False
+
+
+PREFETCH_POLL_SECONDS = 0.5
+PREFETCH_MAX_ATTEMPTS = 3
+
+
+def get_prefetcher(datasette):
+    prefetcher = getattr(datasette, "big_local_prefetcher", None)
+    if prefetcher is None:
+        datasette.big_local_prefetcher = prefetcher = Prefetcher()
+    return prefetcher
+
+
+def queue_prefetches(datasette, project_id, files, remember_token):
+    settings = get_settings(datasette)
+    if not settings.prefetch_size_limit_mb:
+        return
+    size_limit = (
+        min(settings.prefetch_size_limit_mb, settings.csv_size_limit_mb) * 1024 * 1024
+    )
+    prefetcher = get_prefetcher(datasette)
+    project_uuid = project_id_to_uuid(project_id)
+    small_files = sorted(
+        (
+            file
+            for file in files
+            if importable(file["name"]) and file["size"] <= size_limit
+        ),
+        key=lambda file: file["size"],
+    )
+    for file in small_files[: settings.prefetch_max_files]:
+        key = (project_uuid, file["table_name"])
+        running = prefetcher.running
+        if running is None or running.key != key:
+            prefetcher.queue[key] = (project_id, file["name"], remember_token)
+    if prefetcher.queue and prefetcher.worker is None:
+        prefetcher.worker = asyncio.ensure_future(run_prefetches(datasette))
+
+
+async def run_prefetches(datasette):
+    prefetcher = get_prefetcher(datasette)
+    metrics = get_metrics(datasette)
+    try:
+        while prefetcher.queue:
+            if prefetcher.interactive:
+                await asyncio.sleep(PREFETCH_POLL_SECONDS)
+                continue
+            key, job = prefetcher.queue.popitem(last=False)
+            project_uuid, table_name = key
+            project_id, filename, remember_token = job
+            db = ensure_database(datasette, project_uuid)
+            if not await table_needs_import(db, table_name):
+                continue
+            # Tables evicted to save space come back when visited, not before,
+            # and nothing is prefetched into a project that is out of space
+            if table_name in await db.evicted_tables() or exceeds_disk_limits(
+                datasette, project_uuid
+            ):
+                continue
+            try:
+                uri, etag, length = await open_project_file(
+                    datasette, project_id, filename, remember_token
+                )
+            except (OpenError, BigLocalUnavailable, httpx.HTTPError):
+                metrics.inc("big_local_prefetch_imports_total", outcome="failed")
+                continue
+            if exceeds_disk_limits(datasette, project_uuid, length):
+                continue
+            # Check again - a user may have opened it while we were signing the URL
+            if not await table_needs_import(db, table_name):
+                continue
+            prefetch = PrefetchImport(key, job)
+            prefetcher.running = prefetch
+            try:
+                started = await import_file(
+                    db,
+                    uri,
+                    table_name,
+                    prefetch=prefetch,
+                    etag=etag,
+                    finished=prefetch.finished,
+                )
+                if started:
+                    await prefetch.finished.wait()
+            finally:
+                prefetcher.running = None
+            if not started:
+                # Another worker is importing it, or already has
+                continue
+            if prefetch.discarded:
+                metrics.inc("big_local_prefetch_imports_total", outcome="cancelled")
+                prefetcher.attempts[key] += 1
+                if prefetch.claimed:
+                    # Claimed just too late to keep its rows - someone is
+                    # waiting for this one, so it goes first
+                    prefetcher.queue[key] = job
+                    prefetcher.queue.move_to_end(key, last=False)
+                elif prefetcher.attempts[key] < PREFETCH_MAX_ATTEMPTS:
+                    prefetcher.queue[key] = job
+            else:
+                metrics.inc("big_local_prefetch_imports_total", outcome="imported")
+                prefetcher.attempts.pop(key, None)
+    finally:
+        prefetcher.worker = None
+
+
+def discard_import(conn, task_id, table_name):
+    # Throw away the partly imported table from a cancelled import
+    database = sqlite_utils.Database(conn)
+    if database[table_name].exists():
+        database[table_name].drop()
+    database["_import_progress_"].delete_where("id = ?", [task_id])
+
+
+class ImportLock:
+    """
+    An exclusive lock on importing one table, shared by every Datasette
+    process using the same root_dir. The operating system releases it when
+    the process holding it exits, so a dead worker never blocks an import.
+    """
+
+    def __init__(self, root_dir, database, table):
+        lock_dir = pathlib.Path(root_dir) / ".import-locks"
+        lock_dir.mkdir(exist_ok=True)
+        # Encoded table names can be longer than file systems allow
+        self.path = lock_dir / "{}-{}.lock".format(
+            database, hashlib.sha1(table.encode("utf-8")).hexdigest()[:16]
+        )
+        self.fp = None
+
+    def acquire(self):
+        fp = open(self.path, "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                fp.close()
+                return False
+        self.fp = fp
+        return True
+
+    def release(self):
+        if self.fp is not None:
+            # Closing the file releases the lock
+            self.fp.close()
+            self.fp = None
+
+    def is_held_elsewhere(self):
+        if not self.acquire():
+            return True
+        self.release()
+        return False
+
+
+def import_stage_sql(conn):
+    # Rows from before stages were recorded are all imports
+    if "stage" in sqlite_utils.Database(conn)["_import_progress_"].columns_dict:
+        return "(stage is null or stage = 'import')"
+    return "1"
+
+
+def load_import_state(conn, table_name):
+    database = sqlite_utils.Database(conn)
+    if not database[table_name].exists():
+        return "missing"
+    if database["_import_progress_"].exists():
+        latest = conn.execute(
+            "select completed from _import_progress_ where [table] = ? and {}"
+            " order by started desc limit 1".format(import_stage_sql(conn)),
+            [table_name],
+        ).fetchall()
+        if latest and latest[0][0] is None:
+            # Nobody holds the lock, so whoever started this import died
+            return "abandoned"
+        # Or died after the rows were in, before the transform and indexes
+        if conn.execute(
+            "select 1 from _import_progress_ where [table] = ? and stage = 'finish'"
+            " and completed is null",
+            [table_name],
+        ).fetchall():
+            return "abandoned"
+    return "complete"
+
+
+def discard_abandoned_import(conn, table_name):
+    database = sqlite_utils.Database(conn)
+    for name in ("{}_fts".format(table_name), table_name):
+        if database[name].exists():
+            database[name].drop()
+    database["_import_progress_"].delete_where(
+        "[table] = ? and completed is null", [table_name]
+    )
+
+
+async def table_needs_import(db, table_name):
+    """
+    True if table_name does not exist, or is what is left of an import by a
+    worker that died part way through, which import_file starts again
+    """
+    if not await db.table_exists(table_name):
+        return True
+    if isinstance(db, ProjectDatabase) and table_name in db._importing_tables:
+        return False
+    state = await db.execute_fn(lambda conn: load_import_state(conn, table_name))
+    if state != "abandoned":
+        return False
+    lock = ImportLock(get_settings(db.ds).root_dir, db.name, table_name)
+    return not lock.is_held_elsewhere()
+
+
+IMPORT_FOLLOW_SECONDS = 10
+
+
+async def follow_import(db, table_name):
+    """
+    Wait for an import running in another worker to create its table, so the
+    user can be sent to its page to follow the progress
+    """
+    lock = ImportLock(get_settings(db.ds).root_dir, db.name, table_name)
+    deadline = time.monotonic() + IMPORT_FOLLOW_SECONDS
+    while time.monotonic() < deadline:
+        if await db.table_exists(table_name) or not lock.is_held_elsewhere():
+            return
+        await asyncio.sleep(0.25)
+
+
+class BulkImport:
+    "The files queued by a whole-project import, and how far each has got"
+
+    def __init__(self, filenames):
+        # table_name => {"filename": ..., "status": ..., "error": ...}
+        self.files = collections.OrderedDict(
+            (
+                alnum_encode(filename),
+                {"filename": filename, "status": "queued", "error": None},
+            )
+            for filename in filenames
+        )
+
+    @property
+    def done(self):
+        return all(
+            file["status"] in ("imported", "failed", "skipped")
+            for file in self.files.values()
+        )
+
+    async def progress(self, db):
+        "The files with rows and bytes so far from _import_progress_"
+        table_names = list(self.files)
+
+        def load_progress(conn):
+            if not sqlite_utils.Database(conn)["_import_progress_"].exists():
+                return {}
+            rows = conn.execute(
+                """
+                select [table], rows_done, bytes_done, bytes_todo
+                from _import_progress_
+                where {} and [table] in ({})
+                order by started
+                """.format(
+                    import_stage_sql(conn), ", ".join("?" for _ in table_names)
+                ),
+                table_names,
+            ).fetchall()
+            return {row[0]: row for row in rows}
+
+        progress = await db.execute_fn(load_progress)
+        files = []
+        for table_name, file in self.files.items():
+            row = progress.get(table_name)
+            files.append(
+                dict(
+                    file,
+                    table_name=table_name,
+                    rows_done=row[1] if row else None,
+                    bytes_done=row[2] if row else None,
+                    bytes_todo=row[3] if row else None,
+                )
+            )
+        return files
+
+
+def get_bulk_imports(datasette):
+    # project_uuid => the latest BulkImport for that project
+    bulk_imports = getattr(datasette, "big_local_bulk_imports", None)
+    if bulk_imports is None:
+        datasette.big_local_bulk_imports = bulk_imports = {}
+    return bulk_imports
+
+
+def get_bulk_import_semaphore(datasette):
+    # Shared by every project, so bulk imports can't swamp the server
+    semaphore = getattr(datasette, "big_local_bulk_import_semaphore", None)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(get_settings(datasette).bulk_import_concurrency)
+        datasette.big_local_bulk_import_semaphore = semaphore
+    return semaphore
+
+
+async def run_bulk_import(datasette, db, project_id, filenames, remember_token):
+    # db was pinned by the caller, so it is not detached until this finishes
+    bulk_import = get_bulk_imports(datasette)[db.name]
+    metrics = get_metrics(datasette)
+    prefetcher = get_prefetcher(datasette)
+    semaphore = get_bulk_import_semaphore(datasette)
+    size_limit = get_settings(datasette).csv_size_limit_mb * 1024 * 1024
+    opened = {}
+
+    async def run(filename):
+        table_name = alnum_encode(filename)
+        file = bulk_import.files[table_name]
+        result = opened[filename]
+        if isinstance(result, OpenError):
+            file.update(status="failed", error=str(result))
+            return
+        uri, etag, length = result
+        if length > size_limit:
+            file.update(status="failed", error="File exceeds size limit")
+            return
+        async with semaphore:
+            # A background prefetch of this file counts as this import
+            if prefetcher.claim((db.name, table_name)) or not await table_needs_import(
+                db, table_name
+            ):
+                file["status"] = "skipped"
+                return
+            finished = asyncio.Event()
+            file["status"] = "importing"
+            if not await import_file(db, uri, table_name, etag=etag, finished=finished):
+                # Another worker is importing it, or already has
+                file["status"] = "skipped"
+                return
+            await finished.wait()
+        if await db.table_exists(table_name):
+            file["status"] = "imported"
+        else:
+            file.update(status="failed", error="Import failed")
+
+    async def run_and_record(filename):
+        try:
+            await run(filename)
+        except Exception as e:
+            bulk_import.files[alnum_encode(filename)].update(
+                status="failed", error=str(e)
+            )
+        metrics.inc(
+            "big_local_bulk_imports_total",
+            outcome=bulk_import.files[alnum_encode(filename)]["status"],
+        )
+
+    try:
+        try:
+            opened.update(
+                await open_project_files(
+                    datasette, project_id, filenames, remember_token
+                )
+            )
+        except (httpx.HTTPError, BigLocalUnavailable) as e:
+            opened.update((filename, OpenError(str(e))) for filename in filenames)
+        await asyncio.gather(*(run_and_record(filename) for filename in filenames))
+    finally:
+        unpin_database(datasette, db.name)
+
+
+async def import_file(
+    db, url, table_name, profile=False, prefetch=None, etag=None, finished=None
+):
+    """
+    Start importing url into table_name in the background. Returns False
+    without importing if another worker is already importing that table, or
+    has already imported it. Otherwise the finished asyncio.Event, if given,
+    is set once the import and its post-import stages are done.
+    """
+    lock = ImportLock(get_settings(db.ds).root_dir, db.name, table_name)
+    if not lock.acquire():
+        return False
+    try:
+        state = await db.execute_fn(lambda conn: load_import_state(conn, table_name))
+    except Exception:
+        lock.release()
+        raise
+    if state == "complete":
+        # Another worker finished it between our check and taking the lock
+        lock.release()
+        return False
     task_id = str(uuid.uuid4())
+    trace = ImportTrace()
+    prefetcher = get_prefetcher(db.ds)
+    # Anything still being built for an earlier import of this table is stale
+    post_import = PostImportTask()
+    post_import_tasks = get_post_import_tasks(db.ds)
+    previous = post_import_tasks.pop((db.name, table_name), None)
+    if previous is not None:
+        previous.cancel()
+    post_import_tasks[(db.name, table_name)] = post_import
 
     def insert_initial_record(conn):
+        if state == "abandoned":
+            discard_abandoned_import(conn, table_name)
+        insert_progress_record(conn, task_id, table_name, "import", etag)
         database = sqlite_utils.Database(conn)
-        if "_import_progress_" not in database.table_names():
-            database["_import_progress_"].create(
-                {
-                    "id": str,
-                    "table": str,
-                    "bytes_todo": int,
-                    "bytes_done": int,
-                    "rows_done": int,
-                    "started": str,
-                    "completed": str,
-                },
-                pk="id",
+        if database["_evicted_tables_"].exists():
+            database["_evicted_tables_"].delete_where("[table] = ?", [table_name])
+            db._evicted_tables = None
+        if isinstance(db, ProjectDatabase):
+            # Stats from an earlier import of this table are stale now
+            delete_table_stats(conn, table_name)
+            db.set_table_stats(table_name, None)
+            db.begin_bulk_import(conn)
+
+    # Running imports pin their database so it is never evicted
+    pin_database(db.ds, db.name)
+    if prefetch is None:
+        prefetcher.interactive_started()
+    if isinstance(db, ProjectDatabase):
+        db.table_import_started(table_name)
+    try:
+        await db.execute_write_fn(insert_initial_record)
+    except Exception:
+        lock.release()
+        unpin_database(db.ds, db.name)
+        if prefetch is None:
+            prefetcher.interactive_finished()
+        if finished is not None:
+            finished.set()
+        if isinstance(db, ProjectDatabase):
+            db.table_import_finished(table_name, exists=False)
+        raise
+
+    def finish_import(conn):
+        save_import_trace(conn, task_id, table_name, trace)
+        # Queued after the transform and every post-import write
+        with conn:
+            conn.execute(
+                "update _import_progress_ set completed = ? where id = ?",
+                [str(datetime.datetime.utcnow()), finish_stage_id(task_id)],
             )
-        database["_import_progress_"].insert(
-            {
-                "id": task_id,
-                "table": table_name,
-                "bytes_todo": None,
-                "bytes_done": 0,
-                "rows_done": 0,
-                "started": str(datetime.datetime.utcnow()),
-                "completed": None,
-            }
+        if sampler is not None:
+            sampler.stop()
+        if isinstance(db, ProjectDatabase):
+            db.end_bulk_import(conn)
+            db.table_import_finished(
+                table_name, sqlite_utils.Database(conn)[table_name].exists()
+            )
+            db._evicted_tables = None
+            db.save_table_access(conn)
+        lock.release()
+        unpin_database(db.ds, db.name)
+        if prefetch is None:
+            prefetcher.interactive_finished()
+        if finished is not None:
+            loop.call_soon_threadsafe(finished.set)
+        # The new table may have taken the project or root_dir over its limit
+        asyncio.run_coroutine_threadsafe(
+            enforce_disk_quotas(db.ds, keep=(db.name, table_name)), loop
         )
 
-    await db.execute_write_fn(insert_initial_record)
+    loop = asyncio.get_event_loop()
+    sampler = None
+
+    def run_import():
+        try:
+            types, profiler = fetch_and_insert_in_thread(
+                task_id,
+                url,
+                db,
+                table_name,
+                loop,
+                trace,
+                prefetch=prefetch,
+            )
+            run_post_import_stages(
+                db, table_name, types, profiler, post_import, loop, trace
+            )
+        except ImportCancelled:
+            prefetch.discarded = True
+            asyncio.run_coroutine_threadsafe(
+                db.execute_write_fn(
+                    lambda conn: discard_import(conn, task_id, table_name),
+                    block=False,
+                ),
+                loop,
+            )
+        finally:
+            if post_import_tasks.get((db.name, table_name)) is post_import:
+                del post_import_tasks[(db.name, table_name)]
+            # Restore pragmas and unpin once every queued write has been applied.
+            # Thread-safe, so this is queued even if the event loop is idle
+            asyncio.run_coroutine_threadsafe(
+                db.execute_write_fn(finish_import, block=False),
+                loop,
+            )
 
     # We run this in a thread to avoid blocking
-    thread = threading.Thread(
-        target=functools.partial(
-            fetch_and_insert_csv_in_thread,
-            task_id,
-            url,
-            db,
-            table_name,
-            asyncio.get_event_loop(),
-        ),
-        daemon=True,
-    )
+    thread = threading.Thread(target=run_import, daemon=True)
+    if profile:
+        # Sample the import thread and the database's write thread
+        sampler = start_profile(
+            db.ds,
+            "import {} {}".format(db.name, table_name),
+            lambda: [t.ident for t in (thread, db._write_thread) if t is not None],
+        )
     thread.start()
+    return True
 
 
 BATCH_SIZE = 100
 
 
-def fetch_and_insert_csv_in_thread(task_id, url, database, table_name, loop):
-    bytes_todo = None
-    bytes_done = 0
-    tracker = TypeTracker()
+class IterStream(io.RawIOBase):
+    "A read-only file object over an iterator of byte chunks"
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.leftover = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.leftover:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.leftover = chunk
+        size = min(len(buffer), len(self.leftover))
+        buffer[:size] = self.leftover[:size]
+        self.leftover = self.leftover[size:]
+        return size
+
+
+class Download:
+    "A file being downloaded for import, counting bytes as they are read"
+
+    def __init__(self, url, metrics, trace):
+        self.url = url
+        self.metrics = metrics
+        self.trace = trace
+        self.bytes_todo = None
+        self.bytes_done = 0
+        self._peeked = b""
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._stream = httpx.stream("GET", self.url)
+        self.response = self._stream.__enter__()
+        self.metrics.observe(
+            "big_local_storage_seconds", time.perf_counter() - start, method="GET"
+        )
+        try:
+            self.bytes_todo = int(self.response.headers["content-length"])
+        except (KeyError, ValueError):
+            self.bytes_todo = None
+        self._chunks = self.response.iter_bytes()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stream.__exit__(*exc_info)
+
+    def peek(self, size):
+        "The first size bytes, without consuming them"
+        while len(self._peeked) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._peeked += chunk
+        return self._peeked[:size]
+
+    def iter_bytes(self):
+        if self._peeked:
+            chunk, self._peeked = self._peeked, b""
+            self.bytes_done += len(chunk)
+            yield chunk
+        for chunk in self.trace.timed(self._chunks, "download"):
+            self.bytes_done += len(chunk)
+            yield chunk
+
+    def text(self):
+        # utf-8-sig drops the byte order mark that Excel puts on CSV exports
+        return io.TextIOWrapper(
+            io.BufferedReader(IterStream(self.iter_bytes())),
+            encoding=self.response.charset_encoding or "utf-8-sig",
+            errors="replace",
+            newline="",
+        )
+
+    def spool(self):
+        "Save the file to disk, for formats that can only be read by seeking"
+        fp = tempfile.TemporaryFile()
+        for chunk in self.iter_bytes():
+            fp.write(chunk)
+        fp.seek(0)
+        return fp
+
+
+def sqlite_value(value):
+    # Values from typed formats that SQLite can not store as they are
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, default=str)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return value
+
+
+class FileReader(abc.ABC):
+    """
+    Turns a Download into rows. Readers for formats that carry their own
+    types set typed, so their rows skip type detection and the transform.
+    """
+
+    extensions = ()
+    # Module needed to read this format, an optional dependency
+    requires = None
+    typed = False
+
+    def __init__(self, download, trace, filename):
+        self.download = download
+        self.trace = trace
+        self.filename = filename
+        # {column: Python type} if known before the first row
+        self.columns = None
+
+    @classmethod
+    def available(cls):
+        return (
+            cls.requires is None or importlib.util.find_spec(cls.requires) is not None
+        )
+
+    @classmethod
+    def sniff(cls, first_bytes):
+        return False
 
-    def stream_lines():
-        nonlocal bytes_todo, bytes_done
-        with httpx.stream("GET", url) as r:
-            try:
-                bytes_todo = int(r.headers["content-length"])
-            except TypeError:
-                bytes_todo = None
-            for line in r.iter_lines():
-                bytes_done += len(line)
-                yield line
-
-    reader = csv_std.reader(stream_lines())
-    headers = next(reader)
-    docs = (dict(zip(headers, row)) for row in reader)
-
-    def update_progress(data):
-        asyncio.ensure_future(
-            database.execute_write_fn(
-                lambda conn: sqlite_utils.Database(conn)["_import_progress_"].update(
-                    task_id, data
-                ),
-                block=True,
-            ),
-            loop=loop,
+    @abc.abstractmethod
+    def rows(self):
+        "Yields a dict for each row"
+
+
+class CSVReader(FileReader):
+    extensions = (".csv", ".tsv")
+
+    def rows(self):
+        delimiter = "\t" if self.filename.lower().endswith(".tsv") else ","
+        reader = self.trace.timed(
+            csv_std.reader(self.download.text(), delimiter=delimiter), "parse"
         )
+        headers = next(reader, None)
+        if headers is None:
+            return
+        for row in reader:
+            yield dict(zip(headers, row))
+
+
+class JSONLinesReader(FileReader):
+    extensions = (".jsonl", ".ndjson")
+    typed = True
+
+    @classmethod
+    def sniff(cls, first_bytes):
+        return first_bytes.lstrip().startswith(b"{")
+
+    def rows(self):
+        for line in self.trace.timed(self.download.text(), "parse"):
+            if not line.strip():
+                continue
+            with self.trace.phase("parse"):
+                doc = json.loads(line)
+                if not isinstance(doc, dict):
+                    doc = {"value": doc}
+                doc = {key: sqlite_value(value) for key, value in doc.items()}
+            yield doc
+
+
+def arrow_column_type(arrow_type):
+    import pyarrow.types
+
+    if pyarrow.types.is_integer(arrow_type) or pyarrow.types.is_boolean(arrow_type):
+        return int
+    if pyarrow.types.is_floating(arrow_type) or pyarrow.types.is_decimal(arrow_type):
+        return float
+    if pyarrow.types.is_binary(arrow_type) or pyarrow.types.is_large_binary(arrow_type):
+        return bytes
+    return str
+
+
+class ParquetReader(FileReader):
+    extensions = (".parquet",)
+    requires = "pyarrow"
+    typed = True
+
+    @classmethod
+    def sniff(cls, first_bytes):
+        return first_bytes.startswith(b"PAR1")
+
+    def rows(self):
+        import pyarrow.parquet
+
+        # The schema and row group offsets are in the footer, so it needs the
+        # whole file - but then only one row group is held in memory at a time
+        with self.download.spool() as fp:
+            parquet_file = pyarrow.parquet.ParquetFile(fp)
+            self.columns = {
+                field.name: arrow_column_type(field.type)
+                for field in parquet_file.schema_arrow
+            }
+            for i in range(parquet_file.num_row_groups):
+                with self.trace.phase("parse"):
+                    rows = parquet_file.read_row_group(i).to_pylist()
+                for row in rows:
+                    yield {key: sqlite_value(value) for key, value in row.items()}
 
-    def write_batch(docs):
-        asyncio.ensure_future(
-            database.execute_write_fn(
-                lambda conn: sqlite_utils.Database(conn)[table_name].insert_all(
-                    docs, alter=True
-                ),
-                block=True,
-            ),
-            loop=loop,
+
+class ExcelReader(FileReader):
+    extensions = (".xlsx",)
+    requires = "openpyxl"
+    typed = True
+
+    @classmethod
+    def sniff(cls, first_bytes):
+        # A zip file, which is what .xlsx files are
+        return first_bytes.startswith(b"PK\x03\x04")
+
+    def rows(self):
+        import openpyxl
+
+        with self.download.spool() as fp:
+            workbook = openpyxl.load_workbook(fp, read_only=True, data_only=True)
+            try:
+                rows = self.trace.timed(
+                    workbook.worksheets[0].iter_rows(values_only=True), "parse"
+                )
+                headers = next(rows, None)
+                if headers is None:
+                    return
+                headers = [
+                    "column_{}".format(i + 1) if header is None else str(header)
+                    for i, header in enumerate(headers)
+                ]
+                for row in rows:
+                    if all(value is None for value in row):
+                        continue
+                    yield {
+                        header: sqlite_value(value)
+                        for header, value in zip(headers, row)
+                    }
+            finally:
+                workbook.close()
+
+
+# CSV last: it is also used for files that nothing else recognizes
+READERS = (JSONLinesReader, ParquetReader, ExcelReader, CSVReader)
+
+
+def reader_for_filename(filename):
+    for reader in READERS:
+        if filename.lower().endswith(reader.extensions):
+            return reader
+    return None
+
+
+def importable(filename):
+    reader = reader_for_filename(filename)
+    return reader is not None and reader.available()
+
+
+def choose_reader(filename, download):
+    reader = reader_for_filename(filename)
+    if reader is None:
+        # Unknown extension, so look at the content
+        first_bytes = download.peek(8)
+        reader = next(
+            (r for r in READERS if r.available() and r.sniff(first_bytes)),
+            CSVReader,
         )
+    if not reader.available():
+        raise ImportError("Importing {} requires {}".format(filename, reader.requires))
+    return reader
 
-    gathered = []
-    i = 0
-    for doc in tracker.wrap(docs):
-        gathered.append(doc)
-        i += 1
-        if len(gathered) >= BATCH_SIZE:
-            write_batch(gathered)
-            gathered = []
-            # Update progress table
-            update_progress(
-                {
-                    "rows_done": i,
-                    "bytes_todo": bytes_todo,
-                    "bytes_done": bytes_done,
-                }
+
+SQLITE_TYPES = {int: "integer", float: "float", str: "text", bytes: "blob"}
+
+
+def column_types(conn, table_name):
+    # The same shape as TypeTracker.types, for formats that were already typed
+    table = sqlite_utils.Database(conn)[table_name]
+    if not table.exists():
+        return {}
+    return {
+        column: SQLITE_TYPES.get(type, "text")
+        for column, type in table.columns_dict.items()
+    }
+
+
+def fetch_and_insert_in_thread(
+    task_id, url, database, table_name, loop, trace=None, prefetch=None
+):
+    trace = trace or ImportTrace()
+    profiler = ColumnProfiler()
+    metrics = get_metrics(database.ds)
+    filename = alnum_decode(table_name)
+
+    with Download(url, metrics, trace) as download:
+        reader = choose_reader(filename, download)(download, trace, filename)
+        docs = reader.rows()
+        tracker = None
+        if not reader.typed:
+            tracker = TypeTracker()
+            docs = trace.timed(tracker.wrap(docs), "type_tracking")
+
+        def update_progress(data):
+            def update(conn):
+                sqlite_utils.Database(conn)["_import_progress_"].update(task_id, data)
+                # Save the trace as we go, so slow imports can be diagnosed
+                if time.monotonic() - trace.saved > 1:
+                    trace.saved = time.monotonic()
+                    save_import_trace(conn, task_id, table_name, trace)
+
+            asyncio.ensure_future(
+                database.execute_write_fn(update, block=True),
+                loop=loop,
+            )
+
+        bytes_counted = 0
+        created = False
+
+        def write_batch(docs):
+            nonlocal bytes_counted, created
+            # Counted per batch, not per row or line, to keep the loop cheap
+            metrics.inc("big_local_import_rows_total", len(docs))
+            metrics.inc(
+                "big_local_import_bytes_total", download.bytes_done - bytes_counted
+            )
+            bytes_counted = download.bytes_done
+            # Formats with a schema get their column types before the first row
+            columns = None if created else reader.columns
+            created = True
+
+            def insert_batch(conn):
+                start = time.perf_counter()
+                table = sqlite_utils.Database(conn)[table_name]
+                if columns and not table.exists():
+                    table.create(columns)
+                table.insert_all(docs, alter=True)
+                duration = time.perf_counter() - start
+                metrics.observe("big_local_write_batch_seconds", duration)
+                trace.record("insert", duration, rows=len(docs))
+
+            asyncio.ensure_future(
+                database.execute_write_fn(insert_batch, block=True),
+                loop=loop,
             )
 
-    if gathered:
-        # Write any remaining rows
-        write_batch(gathered)
         gathered = []
+        i = 0
+        with trace.phase("batching"):
+            for doc in trace.timed(profiler.wrap(docs), "profiling"):
+                gathered.append(doc)
+                i += 1
+                if len(gathered) >= BATCH_SIZE:
+                    if prefetch is not None and prefetch.is_cancelled():
+                        raise ImportCancelled()
+                    write_batch(gathered)
+                    gathered = []
+                    # Update progress table
+                    update_progress(
+                        {
+                            "rows_done": i,
+                            "bytes_todo": download.bytes_todo,
+                            "bytes_done": download.bytes_done,
+                        }
+                    )
+
+            if gathered:
+                # Write any remaining rows
+                write_batch(gathered)
+                gathered = []
+        trace.record("download", bytes=download.bytes_done)
+        trace.record("parse", rows=i)
+
+    # Mark as complete in the table. The transform and post-import stages are
+    # still to run, so a finish stage is opened first - other workers treat
+    # the table as complete, and send ETags for it, only once that is closed
+    def mark_complete(conn):
+        insert_progress_record(conn, finish_stage_id(task_id), table_name, "finish")
+        sqlite_utils.Database(conn)["_import_progress_"].update(
+            task_id,
+            {
+                "rows_done": i,
+                "bytes_done": download.bytes_todo,
+                "completed": str(datetime.datetime.utcnow()),
+            },
+        )
 
-    # Mark as complete in the table
-    update_progress(
-        {
-            "rows_done": i,
-            "bytes_done": bytes_todo,
-            "completed": str(datetime.datetime.utcnow()),
-        }
+    asyncio.ensure_future(
+        database.execute_write_fn(mark_complete, block=True),
+        loop=loop,
     )
 
+    if tracker is None:
+        # Runs after the queued inserts, so the table has every column
+        return (
+            run_write_in_thread(
+                database, lambda conn: column_types(conn, table_name), loop
+            ),
+            profiler,
+        )
+
     # Update the table's schema types
     types = tracker.types
     if not all(v == "text" for v in types.values()):
         # Transform!
+        def transform(conn):
+            start = time.perf_counter()
+            sqlite_utils.Database(conn)[table_name].transform(types=types)
+            trace.record("transform", time.perf_counter() - start, rows=i)
+
         asyncio.ensure_future(
-            database.execute_write_fn(
-                lambda conn: sqlite_utils.Database(conn)[table_name].transform(
-                    types=types
-                ),
-                block=False,
-            ),
+            database.execute_write_fn(transform, block=False),
             loop=loop,
         )
 
+    return types, profiler
+
+
+HASH_MASK = 2**64 - 1
+
+
+class DistinctEstimator:
+    "K minimum values estimate of the number of distinct values in a stream"
+
+    def __init__(self, k=1024):
+        self.k = k
+        # Negated, so heap[0] is the largest of the k smallest hashes
+        self.heap = []
+        self.hashes = set()
+
+    def add(self, value):
+        hashed = hash(value if isinstance(value, str) else str(value)) & HASH_MASK
+        if hashed in self.hashes:
+            return
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, -hashed)
+            self.hashes.add(hashed)
+        elif hashed < -self.heap[0]:
+            self.hashes.discard(-heapq.heappushpop(self.heap, -hashed))
+            self.hashes.add(hashed)
+
+    def estimate(self):
+        if len(self.heap) < self.k:
+            return len(self.heap)
+        return int((self.k - 1) / (-self.heap[0] / HASH_MASK))
+
+
+class ColumnProfiler:
+    "Profiles the null rate, cardinality and range of each column as rows stream past"
+
+    def __init__(self, max_distinct=1000):
+        self.max_distinct = max_distinct
+        self.rows = 0
+        self.nulls = collections.Counter()
+        # Empty strings are stored as they are, so are facet values in SQLite,
+        # but count as blank alongside nulls when choosing indexes
+        self.empties = collections.Counter()
+        self.max_length = collections.Counter()
+        self.total_length = collections.Counter()
+        # Value counts - exact until a column has more than max_distinct values,
+        # after which only the most common are kept and distinct is estimated
+        self.value_counts = {}
+        self.estimators = {}
+        self.minimum = {}
+        self.maximum = {}
+        # Numeric range, dropped from the first value that is not a number
+        self.numeric_minimum = {}
+        self.numeric_maximum = {}
+
+    def wrap(self, docs):
+        for doc in docs:
+            self.rows += 1
+            for key, value in doc.items():
+                counts = self.value_counts.get(key)
+                if counts is None:
+                    counts = self.value_counts[key] = collections.Counter()
+                    self.numeric_minimum[key] = self.numeric_maximum[key] = None
+                if value is None:
+                    self.nulls[key] += 1
+                    continue
+                if value == "":
+                    self.empties[key] += 1
+                else:
+                    text = value if isinstance(value, str) else str(value)
+                    length = len(text)
+                    self.max_length[key] = max(self.max_length[key], length)
+                    self.total_length[key] += length
+                    self._track_range(key, value, text)
+                counts[value] += 1
+                estimator = self.estimators.get(key)
+                if estimator is not None:
+                    estimator.add(value)
+                    if len(counts) > self.max_distinct * 2:
+                        self.value_counts[key] = collections.Counter(
+                            dict(counts.most_common(self.max_distinct))
+                        )
+                elif len(counts) > self.max_distinct:
+                    self.estimators[key] = estimator = DistinctEstimator()
+                    for seen in counts:
+                        estimator.add(seen)
+            yield doc
+
+    def _track_range(self, key, value, text):
+        if key not in self.minimum or text < self.minimum[key]:
+            self.minimum[key] = text
+        if key not in self.maximum or text > self.maximum[key]:
+            self.maximum[key] = text
+        if key not in self.numeric_minimum:
+            return
+        try:
+            number = value if isinstance(value, (int, float)) else float(value)
+        except (TypeError, ValueError):
+            del self.numeric_minimum[key], self.numeric_maximum[key]
+            return
+        low, high = self.numeric_minimum[key], self.numeric_maximum[key]
+        if low is None or number < low:
+            self.numeric_minimum[key] = number
+        if high is None or number > high:
+            self.numeric_maximum[key] = number
+
+    @property
+    def columns(self):
+        return list(self.value_counts.keys())
+
+    def blanks(self, column):
+        return self.nulls[column] + self.empties[column]
+
+    def null_rate(self, column):
+        return self.blanks(column) / self.rows if self.rows else 0
+
+    def average_length(self, column):
+        non_blank = self.rows - self.blanks(column)
+        return self.total_length[column] / non_blank if non_blank else 0
+
+    def distinct_count(self, column):
+        # None means "more than max_distinct"
+        if column in self.estimators:
+            return None
+        return len(self.value_counts.get(column) or ())
+
+    def distinct_estimate(self, column):
+        if column in self.estimators:
+            return self.estimators[column].estimate()
+        return self.distinct_count(column)
+
+    def column_stats(self, column, type, top_values=50):
+        "Statistics for a column, with min/max matching its detected type"
+        if type in ("integer", "float") and column in self.numeric_minimum:
+            cast = int if type == "integer" else float
+            low, high = self.numeric_minimum[column], self.numeric_maximum[column]
+            minimum = None if low is None else cast(low)
+            maximum = None if high is None else cast(high)
+        else:
+            minimum, maximum = self.minimum.get(column), self.maximum.get(column)
+        return {
+            "type": type,
+            "distinct_values": self.distinct_estimate(column),
+            "distinct_exact": column not in self.estimators,
+            "null_count": self.nulls[column],
+            "min": minimum,
+            "max": maximum,
+            "top_values": [
+                [value, count]
+                for value, count in self.value_counts[column].most_common(top_values)
+            ],
+        }
+
+    def index_candidates(self, max_null_rate, limit, max_value_length=200):
+        """
+        Columns worth indexing: low cardinality facet candidates first, fewest
+        distinct values first, then high cardinality filter candidates.
+        Mostly-null, constant and long free text columns are skipped.
+        """
+        facets, filters = [], []
+        for column in self.columns:
+            if self.null_rate(column) > max_null_rate:
+                continue
+            if self.max_length[column] > max_value_length:
+                continue
+            distinct = self.distinct_count(column)
+            if distinct is None:
+                filters.append((self.null_rate(column), column))
+            elif distinct > 1:
+                facets.append((distinct, column))
+        return [column for _, column in sorted(facets) + sorted(filters)][:limit]
+
+    def search_candidates(self, types, min_average_length):
+        "Text columns with long, mostly distinct values - worth full-text search"
+        columns = []
+        for column in self.columns:
+            if types.get(column, "text") != "text":
+                continue
+            if self.average_length(column) < min_average_length:
+                continue
+            distinct = self.distinct_count(column)
+            if distinct is not None and self.empties[column]:
+                distinct -= 1
+            non_blank = self.rows - self.blanks(column)
+            if distinct is not None and distinct < non_blank / 2:
+                continue
+            columns.append(column)
+        return columns
+
+
+class PostImportTask:
+    "Background work on a freshly imported table, which can be cancelled"
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        # The write connection, while a cancellable statement is running
+        self.conn = None
+
+    def cancel(self):
+        self.cancelled.set()
+        conn = self.conn
+        if conn is not None:
+            conn.interrupt()
+
+
+def get_post_import_tasks(datasette):
+    tasks = getattr(datasette, "big_local_post_import_tasks", None)
+    if tasks is None:
+        datasette.big_local_post_import_tasks = tasks = {}
+    return tasks
+
+
+def run_write_in_thread(database, fn, loop):
+    # Block the calling (non event loop) thread until fn has run
+    return asyncio.run_coroutine_threadsafe(
+        database.execute_write_fn(fn, block=True), loop
+    ).result()
+
+
+def run_post_import_stages(
+    database, table_name, types, profiler, task, loop, trace=None
+):
+    trace = trace or ImportTrace()
+    settings = get_settings(database.ds)
+    if isinstance(database, ProjectDatabase):
+        with trace.phase("stats"):
+            write_stats_in_thread(database, table_name, types, profiler, loop)
+    if settings.auto_index and profiler.rows >= settings.auto_index_min_rows:
+        with trace.phase("indexes"):
+            build_indexes_in_thread(database, table_name, profiler, task, loop)
+    if settings.auto_fts:
+        with trace.phase("fts"):
+            build_fts_in_thread(database, table_name, types, profiler, task, loop)
+
+
+def write_stats_in_thread(database, table_name, types, profiler, loop):
+    stats = {
+        "row_count": profiler.rows,
+        "columns": {
+            column: profiler.column_stats(column, types.get(column, "text"))
+            for column in profiler.columns
+        },
+    }
+
+    def write_stats(conn):
+        save_table_stats(conn, table_name, stats)
+        database.set_table_stats(table_name, stats)
+
+    run_write_in_thread(database, write_stats, loop)
+    return stats
+
+
+def build_indexes_in_thread(database, table_name, profiler, task, loop):
+    settings = get_settings(database.ds)
+    columns = profiler.index_candidates(
+        max_null_rate=settings.auto_index_max_null_rate,
+        limit=settings.auto_index_max_indexes,
+    )
+    built = []
+    for column in columns:
+        if task.cancelled.is_set():
+            return built
+        index_name = "idx_{}_{}".format(table_name, column)
+
+        def create_index(conn):
+            task.conn = conn
+            try:
+                if task.cancelled.is_set():
+                    return
+                sqlite_utils.Database(conn)[table_name].create_index(
+                    [column], index_name=index_name, if_not_exists=True
+                )
+            finally:
+                task.conn = None
+
+        # One index per write so other writes can run in between
+        try:
+            run_write_in_thread(database, create_index, loop)
+        except sqlite3.OperationalError:
+            # Interrupted by cancel()
+            return built
+        if not task.cancelled.is_set():
+            built.append((column, index_name))
+
+    def analyze_and_record(conn):
+        if task.cancelled.is_set():
+            return
+        conn.execute("ANALYZE [{}]".format(table_name))
+        database = sqlite_utils.Database(conn)
+        indexes = database["_import_indexes_"]
+        if not indexes.exists():
+            indexes.create(
+                {
+                    "table": str,
+                    "column": str,
+                    "index_name": str,
+                    "distinct_values": int,
+                    "null_rate": float,
+                    "created": str,
+                },
+                pk=("table", "column"),
+            )
+        indexes.delete_where("[table] = ?", [table_name])
+        indexes.insert_all(
+            {
+                "table": table_name,
+                "column": column,
+                "index_name": index_name,
+                "distinct_values": profiler.distinct_count(column),
+                "null_rate": profiler.null_rate(column),
+                "created": str(datetime.datetime.utcnow()),
+            }
+            for column, index_name in built
+        )
+
+    if built:
+        run_write_in_thread(database, analyze_and_record, loop)
+    return built
+
+
+def build_fts_in_thread(database, table_name, types, profiler, task, loop):
+    settings = get_settings(database.ds)
+    columns = profiler.search_candidates(types, settings.fts_min_average_length)
+    if not columns or task.cancelled.is_set():
+        return []
+    fts_table = "{}_fts".format(table_name)
+    progress_id = str(uuid.uuid4())
+
+    def create_fts_table(conn):
+        insert_progress_record(conn, progress_id, table_name, "fts")
+        database = sqlite_utils.Database(conn)
+        if database[fts_table].exists():
+            database[fts_table].drop()
+        # content= is how Datasette spots the FTS table and shows a search box
+        conn.execute(
+            "CREATE VIRTUAL TABLE [{}] USING FTS5 ({}, content=[{}])".format(
+                fts_table,
+                ", ".join("[{}]".format(column) for column in columns),
+                table_name,
+            )
+        )
+        return conn.execute(
+            "select max(rowid) from [{}]".format(table_name)
+        ).fetchone()[0]
+
+    max_rowid = run_write_in_thread(database, create_fts_table, loop) or 0
+    sql = """
+        INSERT INTO [{fts}] (rowid, {cols})
+        SELECT rowid, {cols} FROM [{table}] WHERE rowid > ? AND rowid <= ?
+    """.format(
+        fts=fts_table,
+        cols=", ".join("[{}]".format(column) for column in columns),
+        table=table_name,
+    )
+    batch_size = settings.fts_batch_size
+    for start in range(0, max_rowid, batch_size):
+        if task.cancelled.is_set():
+            return []
+
+        def index_batch(conn):
+            task.conn = conn
+            try:
+                if task.cancelled.is_set():
+                    return
+                with conn:
+                    conn.execute(sql, [start, start + batch_size])
+                    sqlite_utils.Database(conn)["_import_progress_"].update(
+                        progress_id,
+                        {
+                            "rows_done": min(start + batch_size, max_rowid),
+                            "bytes_todo": max_rowid,
+                            "bytes_done": min(start + batch_size, max_rowid),
+                        },
+                    )
+            finally:
+                task.conn = None
+
+        # Each batch is its own write, so interactive writes are not starved
+        try:
+            run_write_in_thread(database, index_batch, loop)
+        except sqlite3.OperationalError:
+            return []
+
+    def mark_complete(conn):
+        sqlite_utils.Database(conn)["_import_progress_"].update(
+            progress_id,
+            {
+                "bytes_todo": max_rowid,
+                "bytes_done": max_rowid,
+                "completed": str(datetime.datetime.utcnow()),
+            },
+        )
+
+    if not task.cancelled.is_set():
+        run_write_in_thread(database, mark_complete, loop)
+    return columns
+
 
 PROGRESS_BAR_JS = """
 const PROGRESS_BAR_CSS = `
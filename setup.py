@@ -29,7 +29,17 @@ setup(
     packages=["datasette_big_local"],
     entry_points={"datasette": ["big_local = datasette_big_local"]},
     install_requires=["datasette", "cachetools", "sqlite-utils"],
-    extras_require={"test": ["pytest", "pytest-asyncio", "pytest-httpx"]},
+    extras_require={
+        "parquet": ["pyarrow"],
+        "excel": ["openpyxl"],
+        "test": [
+            "pytest",
+            "pytest-asyncio",
+            "pytest-httpx",
+            "pyarrow",
+            "openpyxl",
+        ],
+    },
     package_data={
         "datasette_big_local": [
             "templates/*.html",
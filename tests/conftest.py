@@ -0,0 +1,65 @@
+from datasette.app import Datasette
+import asyncio
+import pytest
+
+
+def pytest_configure(config):
+    # Detached project databases end their write thread with SystemExit
+    config.addinivalue_line(
+        "filterwarnings",
+        r"ignore:Exception in thread [\s\S]*\(_execute_writes\)[\s\S]*SystemExit"
+        ":pytest.PytestUnhandledThreadExceptionWarning",
+    )
+
+
+@pytest.fixture
+def non_mocked_hosts():
+    return ["localhost"]
+
+
+@pytest.fixture
+def make_ds(tmpdir):
+    "Builds a Datasette using tmpdir as root_dir, with any other plugin options"
+
+    def make_ds(**config):
+        config = dict(config, root_dir=str(tmpdir))
+        return Datasette(metadata={"plugins": {"datasette-big-local": config}})
+
+    return make_ds
+
+
+@pytest.fixture
+def ds(make_ds):
+    return make_ds()
+
+
+async def poll(check, times=100, interval=0.05):
+    for _ in range(times):
+        await asyncio.sleep(interval)
+        if check():
+            break
+
+
+@pytest.fixture
+def wait_until():
+    return poll
+
+
+@pytest.fixture
+def wait_for_imports():
+    async def wait_for_imports(ds):
+        from datasette_big_local import get_open_databases
+
+        # Databases are pinned open until their imports finish
+        await poll(lambda: not get_open_databases(ds).pins)
+
+    return wait_for_imports
+
+
+@pytest.fixture
+def cookies():
+    def cookies(ds, actor_id="1", token="abc"):
+        actor = {"id": actor_id, "token": token, "display": actor_id}
+        return {"ds_actor": ds.sign({"a": actor}, "actor")}
+
+    return cookies
@@ -4,11 +4,8 @@ import base64
 import json
 import pathlib
 import pytest
-
-
-@pytest.fixture
-def non_mocked_hosts():
-    return ["localhost"]
+import sqlite3
+import sqlite_utils
 
 
 @pytest.mark.asyncio
@@ -185,19 +182,6 @@ async def test_open_file(httpx_mock, ds, tmpdir, graphql_url, exceeds_size_limit
     assert expected_db_path.exists()
 
 
-@pytest.fixture
-def ds(tmpdir):
-    return Datasette(
-        metadata={
-            "plugins": {
-                "datasette-big-local": {
-                    "root_dir": str(tmpdir),
-                }
-            }
-        }
-    )
-
-
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
     "data",
@@ -343,3 +327,1328 @@ async def test_big_local_project(ds, httpx_mock, tmpdir, redirect_path):
     )
     # But universities_massive.csv is too big
     assert "universities_massive.csv" not in response.text
+
+
+@pytest.mark.asyncio
+async def test_idle_databases_evicted_and_reattached(tmpdir, make_ds):
+    from datasette_big_local import ensure_database, pin_database, unpin_database
+
+    ds = make_ds(max_open_databases=1)
+    one = "ff0150c6-b634-472a-81b2-ef2e0c01d224"
+    two = "0f5e1a4b-3f3c-4b8e-9d1e-2a6b7c8d9e0f"
+    three = "a1b2c3d4-e5f6-4789-abcd-ef0123456789"
+    ensure_database(ds, one)
+    ensure_database(ds, two)
+    # First database was evicted, least recently used first
+    assert set(ds.databases.keys()) == {"_internal", "_memory", two}
+    assert (pathlib.Path(tmpdir) / "{}.db".format(one)).exists()
+    # A request for it should transparently attach it again
+    response = await ds.client.get("/{}".format(one))
+    assert response.status_code == 302
+    assert set(ds.databases.keys()) == {"_internal", "_memory", one}
+    # Pinned databases are never evicted
+    pin_database(ds, one)
+    ensure_database(ds, three)
+    assert set(ds.databases.keys()) == {"_internal", "_memory", one, three}
+    unpin_database(ds, one)
+    ensure_database(ds, three)
+    assert set(ds.databases.keys()) == {"_internal", "_memory", three}
+
+    # A detached database sends any later work on to the attached one, rather
+    # than opening its own connections and write thread again
+    detached = ensure_database(ds, two)
+    ensure_database(ds, three)
+    assert two not in ds.databases
+    await detached.execute_write("create table t (id integer)")
+    assert detached._write_thread is None
+    attached = ds.databases[two]
+    assert attached is not detached
+    assert ensure_database(ds, two) is attached
+    assert (await detached.execute("select count(*) from t")).single_value() == 0
+    assert ds.databases[two] is attached
+
+
+@pytest.mark.asyncio
+async def test_detached_database_finishes_queued_writes(ds):
+    import time
+    from datasette_big_local import ensure_database
+
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    await db.execute_write("create table t (id integer)")
+    await db.execute_write_fn(lambda conn: time.sleep(0.3), block=False)
+    await db.execute_write("insert into t values (1)", block=False)
+    # Queued writes keep it busy, so it won't be picked for detaching
+    assert db.is_busy
+    db.record_table_access("t")
+    write_thread = db._write_thread
+    db.close()
+    await asyncio.get_event_loop().run_in_executor(None, write_thread.join, 5)
+    assert not db.is_busy
+    conn = sqlite3.connect(db.path)
+    assert conn.execute("select id from t").fetchall() == [(1,)]
+    assert conn.execute("select [table] from _table_access_").fetchall() == [("t",)]
+
+
+@pytest.mark.asyncio
+async def test_database_performance_profile(ds):
+    from datasette_big_local import ensure_database
+
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+
+    def read_pragmas(conn):
+        return {
+            name: conn.execute("PRAGMA {}".format(name)).fetchone()[0]
+            for name in ("journal_mode", "synchronous", "page_size", "temp_store")
+        }
+
+    assert await db.execute_write_fn(read_pragmas) == {
+        "journal_mode": "wal",
+        "synchronous": 1,
+        "page_size": 4096,
+        "temp_store": 0,
+    }
+    # Bulk import pragmas apply only while an import is running
+    await db.execute_write_fn(db.begin_bulk_import)
+    during = await db.execute_write_fn(read_pragmas)
+    assert (during["synchronous"], during["temp_store"]) == (0, 2)
+    await db.execute_write_fn(db.end_bulk_import)
+    after = await db.execute_write_fn(read_pragmas)
+    assert (after["synchronous"], after["temp_store"]) == (1, 0)
+    # Readers get mmap_size
+    assert (await db.execute("PRAGMA mmap_size")).single_value() == 256 * 1024 * 1024
+
+
+@pytest.mark.asyncio
+async def test_build_indexes_after_import(ds):
+    from datasette_big_local import (
+        ColumnProfiler,
+        PostImportTask,
+        build_indexes_in_thread,
+        ensure_database,
+    )
+
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    rows = [
+        {
+            "id": str(i),
+            "state": ["CA", "NY", "TX"][i % 3],
+            "notes": "",
+            "constant": "x",
+        }
+        for i in range(2000)
+    ]
+    profiler = ColumnProfiler()
+    await db.execute_write_fn(
+        lambda conn: sqlite_utils.Database(conn)["t"].insert_all(profiler.wrap(rows))
+    )
+    assert profiler.rows == 2000
+    assert profiler.null_rate("notes") == 1
+    assert profiler.distinct_count("state") == 3
+    assert profiler.distinct_count("id") is None
+    # Facet candidates first, then high cardinality filter candidates
+    assert profiler.index_candidates(max_null_rate=0.5, limit=5) == ["state", "id"]
+
+    loop = asyncio.get_event_loop()
+    built = await loop.run_in_executor(
+        None, build_indexes_in_thread, db, "t", profiler, PostImportTask(), loop
+    )
+    assert built == [("state", "idx_t_state"), ("id", "idx_t_id")]
+    index_names = {
+        row[0]
+        for row in (
+            await db.execute("select name from sqlite_master where type = 'index'")
+        ).rows
+    }
+    assert {"idx_t_state", "idx_t_id"}.issubset(index_names)
+    assert (await db.execute("select count(*) from sqlite_stat1")).single_value()
+    recorded = (
+        await db.execute("select [column], distinct_values from _import_indexes_")
+    ).rows
+    assert [tuple(row) for row in recorded] == [("state", 3), ("id", None)]
+
+    # A cancelled task builds nothing
+    cancelled = PostImportTask()
+    cancelled.cancel()
+    built = await loop.run_in_executor(
+        None, build_indexes_in_thread, db, "t", profiler, cancelled, loop
+    )
+    assert built == []
+
+
+@pytest.mark.asyncio
+async def test_build_fts_after_import(ds):
+    from datasette_big_local import (
+        ColumnProfiler,
+        PostImportTask,
+        build_fts_in_thread,
+        ensure_database,
+    )
+
+    ds._metadata_local["plugins"]["datasette-big-local"]["fts_batch_size"] = 7
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    rows = [
+        {
+            "id": i,
+            "state": ["CA", "NY"][i % 2],
+            "description": "Row number {} is about {}".format(
+                i, "pelicans" if i == 3 else "nothing much"
+            ),
+        }
+        for i in range(1, 21)
+    ]
+    profiler = ColumnProfiler()
+    await db.execute_write_fn(
+        lambda conn: sqlite_utils.Database(conn)["t"].insert_all(profiler.wrap(rows))
+    )
+    types = {"id": "integer", "state": "text", "description": "text"}
+    assert profiler.search_candidates(types, min_average_length=15) == ["description"]
+    loop = asyncio.get_event_loop()
+    columns = await loop.run_in_executor(
+        None, build_fts_in_thread, db, "t", types, profiler, PostImportTask(), loop
+    )
+    assert columns == ["description"]
+    # Datasette should now detect it and use it for search
+    assert await db.fts_table("t") == "t_fts"
+    assert (
+        await db.execute("select rowid from t_fts where t_fts match 'pelicans'")
+    ).single_value() == 3
+    assert (await db.execute("select count(*) from t_fts")).single_value() == 20
+    progress = (
+        await db.execute(
+            "select stage, bytes_done, bytes_todo, completed is not null"
+            " from _import_progress_"
+        )
+    ).rows
+    assert [tuple(row) for row in progress] == [("fts", 20, 20, 1)]
+
+
+@pytest.mark.asyncio
+async def test_table_stats_served_instead_of_queries(ds, httpx_mock, cookies):
+    from datasette_big_local import (
+        ColumnProfiler,
+        delete_table_stats,
+        ensure_database,
+        write_stats_in_thread,
+    )
+
+    httpx_mock.add_response(
+        url="https://api.biglocalnews.org/graphql",
+        json={"data": {"node": {"id": "...", "name": "Project"}}},
+    )
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    rows = [
+        {"id": str(i), "state": ["CA", "NY", "TX"][i % 3], "score": str(i * 2)}
+        for i in range(1, 101)
+    ]
+    profiler = ColumnProfiler()
+    await db.execute_write_fn(
+        lambda conn: sqlite_utils.Database(conn)["t"].insert_all(profiler.wrap(rows))
+    )
+    loop = asyncio.get_event_loop()
+    stats = await loop.run_in_executor(
+        None,
+        write_stats_in_thread,
+        db,
+        "t",
+        {"id": "integer", "state": "text", "score": "integer"},
+        profiler,
+        loop,
+    )
+    assert stats["row_count"] == 100
+    assert stats["columns"]["score"]["min"] == 2
+    assert stats["columns"]["score"]["max"] == 200
+    assert stats["columns"]["state"]["distinct_values"] == 3
+    assert stats["columns"]["state"]["top_values"][0] == ["NY", 34]
+
+    # Add a row behind the plugin's back - the page should still show stored stats
+    await db.execute_write("insert into t (id, state, score) values (101, 'WA', 1)")
+    signed_in = cookies(ds)
+    response = await ds.client.get(
+        "/ff0150c6-b634-472a-81b2-ef2e0c01d224/t.json", cookies=signed_in
+    )
+    data = response.json()
+    assert data["filtered_table_rows_count"] == 100
+    assert [facet["name"] for facet in data["suggested_facets"]] == ["state"]
+    # Filtered pages still run real queries
+    response = await ds.client.get(
+        "/ff0150c6-b634-472a-81b2-ef2e0c01d224/t.json?state=WA", cookies=signed_in
+    )
+    assert response.json()["filtered_table_rows_count"] == 1
+
+    # Invalidating stats goes back to counting
+    def invalidate(conn):
+        delete_table_stats(conn, "t")
+        db.set_table_stats("t", None)
+
+    await db.execute_write_fn(invalidate)
+    response = await ds.client.get(
+        "/ff0150c6-b634-472a-81b2-ef2e0c01d224/t.json", cookies=signed_in
+    )
+    assert response.json()["filtered_table_rows_count"] == 101
+
+
+@pytest.mark.asyncio
+async def test_table_stats_match_sqlite_for_blank_values(ds):
+    from datasette.database import Database
+    from datasette_big_local import (
+        ColumnProfiler,
+        ensure_database,
+        write_stats_in_thread,
+    )
+
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    rows = [{"id": i, "state": ["CA", "", None, "CA"][i % 4]} for i in range(1, 101)]
+    profiler = ColumnProfiler()
+    await db.execute_write_fn(
+        lambda conn: sqlite_utils.Database(conn)["t"].insert_all(profiler.wrap(rows))
+    )
+    loop = asyncio.get_event_loop()
+    stats = await loop.run_in_executor(
+        None,
+        write_stats_in_thread,
+        db,
+        "t",
+        {"id": "integer", "state": "text"},
+        profiler,
+        loop,
+    )
+    assert stats["columns"]["state"]["null_count"] == 25
+    assert stats["columns"]["state"]["distinct_values"] == 2
+
+    for sql in (
+        "select count(*) from t",
+        "select state as value, count(*) as n from ( select * from t ) "
+        "where value is not null group by value limit 31",
+    ):
+        from_stats = await db.results_from_stats(sql)
+        from_sqlite = await Database.execute(db, sql)
+        assert from_stats is not None
+        assert sorted(tuple(row) for row in from_stats.rows) == sorted(
+            tuple(row) for row in from_sqlite.rows
+        )
+        assert sorted(sorted(dict(row).items()) for row in from_stats.rows) == sorted(
+            sorted(dict(row).items()) for row in from_sqlite.rows
+        )
+
+
+def files_page(names, end_cursor=None):
+    return {
+        "data": {
+            "node": {
+                "id": "UHJvamVjdDpmZjAxNTBjNi1iNjM0LTQ3MmEtODFiMi1lZjJlMGMwMWQyMjQ=",
+                "name": "universities-ppp",
+                "files": {
+                    "pageInfo": {
+                        "hasNextPage": end_cursor is not None,
+                        "endCursor": end_cursor,
+                    },
+                    "edges": [
+                        {"node": {"name": name, "size": 1000.0, "etag": "e-" + name}}
+                        for name in names
+                    ],
+                },
+            }
+        }
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_project_follows_file_cursor(ds, httpx_mock):
+    from datasette_big_local import get_project
+
+    httpx_mock.add_response(json=files_page(["one.csv", "two.csv"], "cursor1"))
+    httpx_mock.add_response(json=files_page(["three.csv"]))
+    project = await get_project(
+        ds, "UHJvamVjdDpmZjAxNTBjNi1iNjM0LTQ3MmEtODFiMi1lZjJlMGMwMWQyMjQ=", "123", True
+    )
+    assert [(f["name"], f["etag"]) for f in project["files"]] == [
+        ("one.csv", "e-one.csv"),
+        ("two.csv", "e-two.csv"),
+        ("three.csv", "e-three.csv"),
+    ]
+    first, second = httpx_mock.get_requests()
+    assert json.loads(first.read())["variables"]["after"] is None
+    assert json.loads(second.read())["variables"]["after"] == "cursor1"
+
+
+@pytest.mark.asyncio
+async def test_project_files_refreshed_in_background(httpx_mock, make_ds):
+    from datasette_big_local import (
+        cached_project_files,
+        get_project_files,
+        store_project_files,
+    )
+
+    ds = make_ds(files_refresh_after=0)
+    project_id = "UHJvamVjdDpmZjAxNTBjNi1iNjM0LTQ3MmEtODFiMi1lZjJlMGMwMWQyMjQ="
+    httpx_mock.add_response(json=files_page(["old.csv", "new.csv"]))
+    store_project_files(ds, project_id, [{"name": "old.csv", "size": 1}], "123")
+    # Returns the current listing straight away, refreshes in the background
+    assert cached_project_files(ds, project_id) == [
+        {"name": "old.csv", "size": 1, "table_name": "old_2e_csv"}
+    ]
+    await asyncio.sleep(0.1)
+    assert not get_project_files(ds).refreshing
+    assert [f["name"] for f in get_project_files(ds).entries[project_id]["files"]] == [
+        "old.csv",
+        "new.csv",
+    ]
+    assert json.loads(httpx_mock.get_requests()[0].read())["variables"]["id"] == (
+        project_id
+    )
+
+    # A listing nobody has looked at for an hour is still shown while it is
+    # refreshed, and dropped once that token can no longer see the project
+    get_project_files(ds).entries[project_id]["fetched"] -= 60 * 60
+    httpx_mock.add_response(json={"data": {"node": None}})
+    assert [f["name"] for f in cached_project_files(ds, project_id)] == [
+        "old.csv",
+        "new.csv",
+    ]
+    await asyncio.sleep(0.1)
+    assert cached_project_files(ds, project_id) is None
+
+
+@pytest.mark.asyncio
+async def test_cached_table_names(ds):
+    from datasette_big_local import ensure_database
+
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    assert await db.cached_table_names() == set()
+    # Tables being imported count as present straight away
+    db.table_import_started("one")
+    assert await db.cached_table_names() == {"one"}
+    await db.execute_write("create table one (id integer)")
+    db.table_import_finished("one", exists=True)
+    assert await db.cached_table_names() == {"one"}
+    # Tables created some other way are picked up once the schema is re-checked
+    await db.execute_write("create table two (id integer)")
+    assert await db.cached_table_names() == {"one"}
+    db._schema_checked = 0
+    assert await db.cached_table_names() == {"one", "two"}
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(httpx_mock, make_ds, cookies):
+    from datasette_big_local import get_big_local_user, get_metrics
+
+    ds = make_ds(admins=["7"])
+    httpx_mock.add_response(
+        url="https://api.biglocalnews.org/graphql",
+        json={"data": {"user": {"id": "1", "displayName": "one"}}},
+    )
+    await get_big_local_user(ds, "123")
+    get_metrics(ds).inc("big_local_import_rows_total", 100)
+
+    assert (await ds.client.get("/-/big-local-metrics")).status_code == 403
+    response = await ds.client.get("/-/big-local-metrics", cookies=cookies(ds, "1"))
+    assert response.status_code == 403
+    response = await ds.client.get("/-/big-local-metrics", cookies=cookies(ds, "7"))
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    assert "# TYPE big_local_import_rows_total counter" in lines
+    assert "big_local_import_rows_total 100" in lines
+    assert "big_local_active_imports 0" in lines
+    assert 'big_local_graphql_seconds_count{operation="get_big_local_user"} 1' in lines
+    assert (
+        'big_local_graphql_seconds_bucket{operation="get_big_local_user",le="+Inf"} 1'
+        in lines
+    )
+
+
+@pytest.mark.asyncio
+async def test_import_trace_and_profiles(ds, httpx_mock, wait_for_imports, cookies):
+    from datasette_big_local import ensure_database, import_file
+
+    httpx_mock.add_response(
+        method="GET",
+        url="https://storage.googleapis.com/table.csv",
+        content=b"a,b\n" + b"".join(b"%d,x\n" % i for i in range(50)),
+    )
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    await import_file(db, "https://storage.googleapis.com/table.csv", "t", profile=True)
+    await wait_for_imports(ds)
+    trace = {
+        row["phase"]: row
+        for row in (
+            await db.execute('select * from _import_trace_ where "table" = ?', ["t"])
+        ).rows
+    }
+    assert {"download", "parse", "type_tracking", "insert", "transform"} <= set(trace)
+    assert trace["parse"]["rows"] == 50
+    assert trace["insert"]["rows"] == 50
+    assert trace["download"]["bytes"] > 0
+    assert all(row["seconds"] >= 0 for row in trace.values())
+
+    assert (await ds.client.get("/-/big-local-profiles")).status_code == 403
+    # Non-admins can not profile requests
+    response = await ds.client.get("/-/versions.json?_big_local_profile=1")
+    assert "x-big-local-profile" not in response.headers
+    response = await ds.client.get(
+        "/-/versions.json?_big_local_profile=1", cookies=cookies(ds, "root")
+    )
+    request_profile = response.headers["x-big-local-profile"]
+    profiles = (
+        await ds.client.get("/-/big-local-profiles", cookies=cookies(ds, "root"))
+    ).json()
+    assert [profile["name"] for profile in profiles] == [
+        "request /-/versions.json",
+        "import ff0150c6-b634-472a-81b2-ef2e0c01d224 t",
+    ]
+    assert profiles[0]["id"] == request_profile
+    assert all(profile["finished"] for profile in profiles)
+    response = await ds.client.get(
+        "/-/big-local-profiles/{}".format(profiles[1]["id"]),
+        cookies=cookies(ds, "root"),
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in response.text.splitlines())
+    response = await ds.client.get(
+        "/-/big-local-profiles/missing", cookies=cookies(ds, "root")
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_prefetch_small_files(httpx_mock, make_ds, wait_until):
+    from datasette_big_local import (
+        PrefetchImport,
+        ensure_database,
+        get_prefetcher,
+        import_file,
+        store_project_files,
+    )
+
+    ds = make_ds(prefetch_size_limit_mb=1)
+    httpx_mock.add_response(
+        method="POST",
+        url="https://api.biglocalnews.org/graphql",
+        json={
+            "data": {
+                "createFileDownloadUri": {
+                    "ok": {
+                        "name": "small.csv",
+                        "uri": "https://storage.googleapis.com/small.csv",
+                    },
+                    "err": None,
+                }
+            }
+        },
+    )
+    httpx_mock.add_response(
+        method="HEAD",
+        url="https://storage.googleapis.com/small.csv",
+        headers={"ETag": "abc", "content-length": "11"},
+    )
+    httpx_mock.add_response(
+        method="GET",
+        url="https://storage.googleapis.com/small.csv",
+        content=b"a,b\n" + b"".join(b"%d,x\n" % i for i in range(250)),
+    )
+    project_id = "UHJvamVjdDpmZjAxNTBjNi1iNjM0LTQ3MmEtODFiMi1lZjJlMGMwMWQyMjQ="
+    files = [
+        {"name": "big.csv", "size": 5 * 1024 * 1024},
+        {"name": "notes.txt", "size": 10},
+        {"name": "small.csv", "size": 1000},
+    ]
+    prefetcher = get_prefetcher(ds)
+    store_project_files(ds, project_id, files, "123")
+    assert list(prefetcher.queue) == [
+        ("ff0150c6-b634-472a-81b2-ef2e0c01d224", "small_2e_csv")
+    ]
+    await wait_until(lambda: prefetcher.worker is None)
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    assert (await db.execute("select count(*) from small_2e_csv")).single_value() == 250
+
+    # Interactive imports cancel a running prefetch, which throws its rows away
+    prefetch = PrefetchImport(("ff0150c6-b634-472a-81b2-ef2e0c01d224", "t"), None)
+    prefetcher.running = prefetch
+    prefetcher.interactive_started()
+    assert prefetch.cancelled.is_set()
+    prefetcher.interactive_finished()
+    await import_file(
+        db,
+        "https://storage.googleapis.com/small.csv",
+        "t",
+        prefetch=prefetch,
+        finished=prefetch.finished,
+    )
+    await asyncio.wait_for(prefetch.finished.wait(), 5)
+    assert not await db.table_exists("t")
+    # But not once a user has opened that file
+    prefetch = PrefetchImport(("ff0150c6-b634-472a-81b2-ef2e0c01d224", "t"), None)
+    prefetcher.running = prefetch
+    assert prefetcher.claim(prefetch.key)
+    prefetcher.interactive_started()
+    assert not prefetch.cancelled.is_set()
+    prefetcher.interactive_finished()
+    # Nor when the claim lands after the cancel, before the import noticed it
+    prefetch = PrefetchImport(("ff0150c6-b634-472a-81b2-ef2e0c01d224", "t"), None)
+    prefetcher.running = prefetch
+    prefetcher.interactive_started()
+    assert prefetch.cancelled.is_set()
+    assert prefetcher.claim(prefetch.key)
+    assert not prefetch.is_cancelled()
+    prefetcher.interactive_finished()
+    await import_file(
+        db,
+        "https://storage.googleapis.com/small.csv",
+        "t",
+        prefetch=prefetch,
+        finished=prefetch.finished,
+    )
+    await asyncio.wait_for(prefetch.finished.wait(), 5)
+    assert not prefetch.discarded
+    assert (await db.execute("select count(*) from t")).single_value() == 250
+
+
+@pytest.mark.asyncio
+async def test_prefetch_skips_evicted_tables_and_full_projects(
+    httpx_mock, make_ds, wait_until
+):
+    from datasette_big_local import (
+        ensure_database,
+        evict_table,
+        get_prefetcher,
+        store_project_files,
+    )
+
+    project_id = "UHJvamVjdDpmZjAxNTBjNi1iNjM0LTQ3MmEtODFiMi1lZjJlMGMwMWQyMjQ="
+    files = [{"name": "small.csv", "size": 1000}, {"name": "other.csv", "size": 10}]
+    ds = make_ds(prefetch_size_limit_mb=1)
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    await db.execute_write("create table small_2e_csv (id integer)")
+    await db.execute_write_fn(lambda conn: evict_table(conn, "small_2e_csv"))
+    prefetcher = get_prefetcher(ds)
+    store_project_files(ds, project_id, files[:1], "123")
+    await wait_until(lambda: prefetcher.worker is None)
+    # Evicted for space, so left until someone visits it
+    assert not httpx_mock.get_requests()
+
+    # Nothing is prefetched into a project that is already over its quota
+    ds = make_ds(prefetch_size_limit_mb=1, project_quota_mb=0.001)
+    prefetcher = get_prefetcher(ds)
+    store_project_files(ds, project_id, files[1:], "123")
+    await wait_until(lambda: prefetcher.worker is None)
+    assert not httpx_mock.get_requests()
+
+
+@pytest.mark.asyncio
+async def test_open_waits_for_claimed_prefetch(ds, httpx_mock, tmpdir, cookies):
+    from datasette_big_local import (
+        ImportLock,
+        PrefetchImport,
+        ensure_database,
+        get_prefetcher,
+    )
+
+    httpx_mock.add_response(
+        method="POST",
+        url="https://api.biglocalnews.org/graphql",
+        json={
+            "data": {
+                "createFileDownloadUri": {
+                    "ok": {"uri": "https://storage.googleapis.com/small.csv"},
+                    "err": None,
+                }
+            }
+        },
+    )
+    httpx_mock.add_response(
+        method="HEAD",
+        url="https://storage.googleapis.com/small.csv",
+        headers={"ETag": "abc", "content-length": "11"},
+    )
+    project_uuid = "ff0150c6-b634-472a-81b2-ef2e0c01d224"
+    db = ensure_database(ds, project_uuid)
+    # A prefetch that has taken the import lock but not created its table yet
+    prefetcher = get_prefetcher(ds)
+    prefetcher.running = PrefetchImport((project_uuid, "small_2e_csv"), None)
+    lock = ImportLock(str(tmpdir), db.name, "small_2e_csv")
+    assert lock.acquire()
+
+    async def create_table():
+        await asyncio.sleep(0.5)
+        await db.execute_write("create table small_2e_csv (a integer)")
+
+    creating = asyncio.ensure_future(create_table())
+    response = await ds.client.post(
+        "/-/big-local-open",
+        data={
+            "project_id": "UHJvamVjdDpmZjAxNTBjNi1iNjM0LTQ3MmEtODFiMi1lZjJlMGMwMWQyMjQ=",
+            "filename": "small.csv",
+            "remember_token": "123",
+        },
+        cookies=cookies(ds, token="123"),
+    )
+    assert response.status_code == 302
+    assert response.headers["Location"] == "/{}/small_2e_csv".format(project_uuid)
+    # Redirected once the prefetch's table is there to show progress
+    assert prefetcher.running.claimed
+    assert creating.done()
+    assert await db.table_exists("small_2e_csv")
+    lock.release()
+
+
+@pytest.mark.asyncio
+async def test_etag_for_completed_tables(ds, httpx_mock, wait_for_imports, cookies):
+    from datasette_big_local import ensure_database, import_file, load_table_validators
+
+    httpx_mock.add_response(
+        method="GET",
+        url="https://storage.googleapis.com/table.csv",
+        content=b"a,b\n1,x\n2,y\n",
+    )
+    httpx_mock.add_response(
+        method="POST",
+        url="https://api.biglocalnews.org/graphql",
+        json={"data": {"node": {"id": "...", "name": "Project"}}},
+    )
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    await import_file(db, "https://storage.googleapis.com/table.csv", "t", etag='"v1"')
+    await wait_for_imports(ds)
+    signed_in = cookies(ds)
+    path = "/ff0150c6-b634-472a-81b2-ef2e0c01d224/t.json"
+    response = await ds.client.get(path, cookies=signed_in)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert etag.startswith('W/"')
+    assert response.headers["cache-control"] == "private, no-cache"
+    # Row pages share the table's validator
+    response = await ds.client.get(
+        "/ff0150c6-b634-472a-81b2-ef2e0c01d224/t/1.json", cookies=signed_in
+    )
+    assert response.headers["etag"] == etag
+
+    response = await ds.client.get(
+        path, cookies=signed_in, headers={"if-none-match": etag}
+    )
+    assert response.status_code == 304
+    assert response.content == b""
+    # Other users get a different validator, and no 304 without permission
+    response = await ds.client.get(path, headers={"if-none-match": etag})
+    assert response.status_code != 304
+    # Internal tables and tables being imported are never cached
+    response = await ds.client.get(
+        "/ff0150c6-b634-472a-81b2-ef2e0c01d224/_import_progress_.json",
+        cookies=signed_in,
+    )
+    assert "etag" not in response.headers
+    db.table_import_started("t")
+    response = await ds.client.get(
+        path, cookies=signed_in, headers={"if-none-match": etag}
+    )
+    assert response.status_code == 200
+    assert "etag" not in response.headers
+
+    # Another worker only sees a table as complete once its transform and
+    # post-import stages are done, not when the rows are all in
+    conn = sqlite3.connect(db.path)
+    assert conn.execute(
+        "select stage, completed is not null from _import_progress_ order by stage"
+    ).fetchall() == [("finish", 1), ("import", 1)]
+    conn.execute("update _import_progress_ set completed = null where stage = 'finish'")
+    conn.commit()
+    assert "t" not in load_table_validators(conn)
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_disk_quota_evicts_least_recently_used_tables(
+    tmpdir, httpx_mock, make_ds, wait_for_imports, cookies
+):
+    from datasette_big_local import (
+        enforce_disk_quotas,
+        ensure_database,
+        import_file,
+    )
+
+    ds = make_ds(auto_fts=False)
+    content = b"id,text\n" + b"".join(
+        b"%d,%s\n" % (i, b"some words about row %d " % i * 4) for i in range(2000)
+    )
+    for name in ("a.csv", "b.csv"):
+        httpx_mock.add_response(
+            method="GET",
+            url="https://storage.googleapis.com/" + name,
+            content=content,
+        )
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+
+    for name in ("a.csv", "b.csv"):
+        await import_file(
+            db, "https://storage.googleapis.com/" + name, name.replace(".", "_2e_")
+        )
+        await wait_for_imports(ds)
+    db_path = pathlib.Path(tmpdir) / "ff0150c6-b634-472a-81b2-ef2e0c01d224.db"
+    # Visiting a makes b the least recently used table
+    db.record_table_access("a_2e_csv")
+    await db.execute_write_fn(
+        lambda conn: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    )
+    size_before = db_path.stat().st_size
+
+    # No limits configured, so nothing happens
+    assert await enforce_disk_quotas(ds) == []
+    ds._metadata_local["plugins"]["datasette-big-local"]["project_quota_mb"] = (
+        (size_before - 1) / 1024 / 1024
+    )
+    assert await enforce_disk_quotas(ds) == [
+        ("ff0150c6-b634-472a-81b2-ef2e0c01d224", "b_2e_csv")
+    ]
+    assert await db.table_exists("a_2e_csv")
+    assert not await db.table_exists("b_2e_csv")
+    assert db_path.stat().st_size < size_before
+    evicted = (await db.execute("select * from _evicted_tables_")).rows
+    assert [(row["table"], row["filename"]) for row in evicted] == [
+        ("b_2e_csv", "b.csv")
+    ]
+
+    # Visiting the evicted table imports it again
+    ds._metadata_local["plugins"]["datasette-big-local"]["project_quota_mb"] = 0
+    httpx_mock.add_response(
+        method="POST",
+        url="https://api.biglocalnews.org/graphql",
+        json={
+            "data": {
+                "createFileDownloadUri": {
+                    "ok": {
+                        "name": "b.csv",
+                        "uri": "https://storage.googleapis.com/b.csv",
+                    },
+                    "err": None,
+                },
+                "node": {"id": "...", "name": "Project"},
+            }
+        },
+    )
+    httpx_mock.add_response(
+        method="HEAD",
+        url="https://storage.googleapis.com/b.csv",
+        headers={"ETag": "abc", "content-length": str(len(content))},
+    )
+    signed_in = cookies(ds)
+    await ds.client.get(
+        "/ff0150c6-b634-472a-81b2-ef2e0c01d224/b_2e_csv", cookies=signed_in
+    )
+    await wait_for_imports(ds)
+    assert (await db.execute("select count(*) from b_2e_csv")).single_value() == 2000
+    assert (
+        await db.execute("select count(*) from _evicted_tables_")
+    ).single_value() == 0
+
+
+@pytest.mark.asyncio
+async def test_import_lock_shared_between_workers(
+    ds, httpx_mock, tmpdir, wait_for_imports, cookies
+):
+    from datasette_big_local import (
+        ImportLock,
+        ensure_database,
+        import_file,
+        insert_progress_record,
+    )
+
+    url = "https://storage.googleapis.com/table.csv"
+    httpx_mock.add_response(
+        method="POST",
+        url="https://api.biglocalnews.org/graphql",
+        json={"data": {"createFileDownloadUri": {"ok": {"uri": url}, "err": None}}},
+    )
+    httpx_mock.add_response(
+        method="HEAD", url=url, headers={"ETag": "abc", "content-length": "12"}
+    )
+    httpx_mock.add_response(method="GET", url=url, content=b"a,b\n1,x\n2,y\n")
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    # Another worker is importing this table
+    other_worker = ImportLock(str(tmpdir), db.name, "t")
+    assert other_worker.acquire()
+    assert not await import_file(db, url, "t")
+    assert not await db.table_exists("t")
+
+    # Then dies part way through, so the lock is released by the OS
+    def partial_import(conn):
+        insert_progress_record(conn, "dead", "t", "import")
+        sqlite_utils.Database(conn)["t"].insert({"a": "stale", "b": "row"})
+
+    await db.execute_write_fn(partial_import)
+    other_worker.release()
+
+    async def open_table():
+        return await ds.client.post(
+            "/-/big-local-open",
+            data={
+                "project_id": "UHJvamVjdDpmZjAxNTBjNi1iNjM0LTQ3MmEtODFiMi1lZjJlMGMwMWQyMjQ=",
+                "filename": "t",
+                "remember_token": "abc",
+            },
+            cookies=cookies(ds),
+        )
+
+    # Opening the table starts its import again, despite the partial table
+    response = await open_table()
+    assert response.status_code == 302
+    await wait_for_imports(ds)
+    rows = (await db.execute("select a, b from t")).rows
+    assert [tuple(row) for row in rows] == [(1, "x"), (2, "y")]
+    assert (
+        await db.execute("select count(*) from _import_progress_ where id = 'dead'")
+    ).single_value() == 0
+
+    def downloads():
+        return len(httpx_mock.get_requests(method="GET", url=url))
+
+    assert downloads() == 1
+    # Already complete, so there is nothing to do
+    response = await open_table()
+    assert response.status_code == 302
+    await wait_for_imports(ds)
+    assert downloads() == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("format", ("parquet", "jsonl", "xlsx", "sniffed_jsonl"))
+async def test_import_typed_formats(ds, httpx_mock, format, wait_for_imports):
+    import io
+    import openpyxl
+    import pyarrow
+    import pyarrow.parquet
+    from datasette_big_local import (
+        alnum_encode,
+        ensure_database,
+        import_file,
+    )
+
+    rows = [
+        {"id": 1, "name": "Cleo", "score": 1.5, "tags": ["a", "b"]},
+        {"id": 2, "name": "Pancakes", "score": None, "tags": []},
+        {"id": 3, "name": "Juniper", "score": 2.5, "tags": ["c"]},
+    ]
+    if format == "parquet":
+        buffer = io.BytesIO()
+        # Two row groups, read one at a time
+        pyarrow.parquet.write_table(
+            pyarrow.Table.from_pylist(rows), buffer, row_group_size=2
+        )
+        content, filename = buffer.getvalue(), "data.parquet"
+    elif format == "xlsx":
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(["id", "name", "score", "tags"])
+        for row in rows:
+            sheet.append(
+                [row["id"], row["name"], row["score"], json.dumps(row["tags"])]
+            )
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        content, filename = buffer.getvalue(), "data.xlsx"
+    else:
+        content = "".join(json.dumps(row) + "\n" for row in rows).encode("utf-8")
+        filename = "data.jsonl" if format == "jsonl" else "data.txt"
+    httpx_mock.add_response(
+        method="GET", url="https://storage.googleapis.com/data", content=content
+    )
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    table = alnum_encode(filename)
+    await import_file(db, "https://storage.googleapis.com/data", table)
+    await wait_for_imports(ds)
+    columns = await db.execute_fn(
+        lambda conn: sqlite_utils.Database(conn)[table].columns_dict
+    )
+    # Types come from the file, with no transform
+    assert columns == {"id": int, "name": str, "score": float, "tags": str}
+    results = await db.execute("select id, name, score, tags from [{}]".format(table))
+    assert [tuple(row) for row in results.rows] == [
+        (1, "Cleo", 1.5, '["a", "b"]'),
+        (2, "Pancakes", None, "[]"),
+        (3, "Juniper", 2.5, '["c"]'),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_import_whole_project(httpx_mock, make_ds, wait_until, cookies):
+    import httpx
+    from datasette_big_local import (
+        ensure_database,
+        get_bulk_imports,
+        get_open_databases,
+        store_project_files,
+    )
+
+    ds = make_ds(bulk_import_concurrency=2)
+    project_uuid = "ff0150c6-b634-472a-81b2-ef2e0c01d224"
+    project_id = "UHJvamVjdDpmZjAxNTBjNi1iNjM0LTQ3MmEtODFiMi1lZjJlMGMwMWQyMjQ="
+    signed = []
+
+    def graphql(request):
+        body = json.loads(request.read())
+        if "createFileDownloadUri" not in body["query"]:
+            allowed = "remember_token=abc" in request.headers["cookie"]
+            node = {"id": "...", "name": "Project"} if allowed else None
+            return httpx.Response(200, json={"data": {"node": node}})
+        signed.append(body["variables"])
+        return httpx.Response(
+            200,
+            json={
+                "data": {
+                    "f"
+                    + key[len("input") :]: {
+                        "ok": {
+                            "name": value["fileName"],
+                            "uri": "https://storage.googleapis.com/"
+                            + value["fileName"],
+                        },
+                        "err": None,
+                    }
+                    for key, value in body["variables"].items()
+                }
+            },
+        )
+
+    httpx_mock.add_callback(graphql, url="https://api.biglocalnews.org/graphql")
+    names = ["one.csv", "two.csv", "three.csv", "missing.csv"]
+    for name in names[:3]:
+        url = "https://storage.googleapis.com/" + name
+        httpx_mock.add_response(
+            method="HEAD", url=url, headers={"ETag": name, "content-length": "10"}
+        )
+        httpx_mock.add_response(method="GET", url=url, content=b"a,b\n1,x\n2,y\n")
+    httpx_mock.add_response(
+        method="HEAD", url="https://storage.googleapis.com/missing.csv", status_code=404
+    )
+    files = [{"name": name, "size": 10} for name in names]
+    files.append({"name": "notes.txt", "size": 10})
+    store_project_files(ds, project_id, files, "abc")
+    db = ensure_database(ds, project_uuid)
+
+    signed_in = cookies(ds)
+    response = await ds.client.get("/" + project_uuid, cookies=signed_in)
+    assert "Import all files" in response.text
+    csrftoken = response.text.split('name="csrftoken" value="')[1].split('"')[0]
+    signed_in["ds_csrftoken"] = response.cookies["ds_csrftoken"]
+
+    # Nothing ticked imports every eligible file
+    response = await ds.client.post(
+        "/-/big-local-import-project",
+        data={"project_id": project_id, "csrftoken": csrftoken},
+        cookies=signed_in,
+    )
+    assert response.status_code == 302
+    assert response.headers["location"] == "/" + project_uuid
+    bulk_import = get_bulk_imports(ds)[project_uuid]
+    # Pinned while files wait their turn, so it is never detached mid-run
+    assert get_open_databases(ds).pins[project_uuid]
+    await wait_until(lambda: bulk_import.done)
+    await wait_until(lambda: not get_open_databases(ds).pins)
+    assert not get_open_databases(ds).pins
+    # All four signed by one GraphQL request
+    assert len(signed) == 1
+    assert sorted(value["fileName"] for value in signed[0].values()) == sorted(names)
+    assert {
+        file["filename"]: file["status"] for file in bulk_import.files.values()
+    } == {
+        "one.csv": "imported",
+        "two.csv": "imported",
+        "three.csv": "imported",
+        "missing.csv": "failed",
+    }
+    for table in ("one_2e_csv", "two_2e_csv", "three_2e_csv"):
+        assert (await db.execute("select count(*) from " + table)).single_value() == 2
+
+    response = await ds.client.get("/" + project_uuid, cookies=signed_in)
+    assert "Importing project files" in response.text
+    assert "missing.csv</td>" in response.text
+    assert "failed: File not found" in response.text
+    assert "location.reload" not in response.text
+
+    # Ticked files import just those, and files already imported are skipped
+    response = await ds.client.post(
+        "/-/big-local-import-project",
+        content="project_id={}&filename=one.csv&csrftoken={}".format(
+            project_id.replace("=", "%3D"), csrftoken
+        ),
+        headers={"content-type": "application/x-www-form-urlencoded"},
+        cookies=signed_in,
+    )
+    assert response.status_code == 302
+    assert len(signed) == 1
+
+    # Users who can't see the project can't start imports, even though the
+    # file listing is cached
+    response = await ds.client.post(
+        "/-/big-local-import-project",
+        data={"project_id": project_id, "csrftoken": csrftoken},
+        cookies=dict(signed_in, **cookies(ds, "2", token="xyz")),
+    )
+    assert response.status_code == 403
+    assert get_bulk_imports(ds)[project_uuid] is bulk_import
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_fails_fast(httpx_mock, make_ds, cookies):
+    import httpx
+    from datasette_big_local import get_cache
+
+    ds = make_ds(
+        circuit_breaker_failures=2,
+        circuit_breaker_probe_seconds=0.1,
+        stale_grant_ttl=300,
+    )
+    project_uuid = "ff0150c6-b634-472a-81b2-ef2e0c01d224"
+    ds.add_memory_database(project_uuid)
+    api = {"down": False, "calls": 0}
+
+    def graphql(request):
+        api["calls"] += 1
+        if api["down"]:
+            raise httpx.ReadTimeout("Timed out", request=request)
+        return httpx.Response(
+            200, json={"data": {"node": {"id": "...", "name": "Project"}}}
+        )
+
+    httpx_mock.add_callback(graphql, url="https://api.biglocalnews.org/graphql")
+
+    response = await ds.client.get(
+        "/" + project_uuid, cookies=cookies(ds, "1", token="1")
+    )
+    assert response.status_code == 200
+    # The decision expires from the permission cache, then the API goes down
+    get_cache(ds).clear()
+    api["down"] = True
+    response = await ds.client.get(
+        "/" + project_uuid, cookies=cookies(ds, "1", token="1")
+    )
+    assert response.status_code == 200
+    # Nothing to fall back on for a new user: sent to sign in again
+    response = await ds.client.get(
+        "/" + project_uuid, cookies=cookies(ds, "2", token="2")
+    )
+    assert response.status_code == 302
+    assert response.headers["location"].startswith("https://biglocalnews.org/")
+    assert api["calls"] == 3
+
+    # That was the second failure in a row, so now calls fail without waiting
+    root = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    state = (await ds.client.get("/-/big-local-circuit", cookies=root)).json()
+    assert state["state"] == "open"
+    assert state["consecutive_failures"] == 2
+    assert state["last_error"] == "get_project timed out"
+    response = await ds.client.get(
+        "/" + project_uuid, cookies=cookies(ds, "3", token="3")
+    )
+    assert response.status_code == 302
+    response = await ds.client.post(
+        "/-/big-local-project",
+        data={
+            "project_id": "UHJvamVjdDpmZjAxNTBjNi1iNjM0LTQ3MmEtODFiMi1lZjJlMGMwMWQyMjQ=",
+            "remember_token": "4",
+        },
+    )
+    assert response.status_code == 503
+    metrics = (await ds.client.get("/-/big-local-metrics", cookies=root)).text
+    assert "big_local_circuit_open 1" in metrics
+    # Datasette checks more than one permission for each page
+    assert 'big_local_circuit_fast_failures_total{operation="get_project"}' in metrics
+    assert (
+        'big_local_circuit_fast_failures_total{operation="get_big_local_user"} 1'
+        in (metrics)
+    )
+    assert "\nbig_local_stale_permissions_total " in metrics
+
+    # Background probes close the circuit once the API is back
+    await asyncio.sleep(0.5)
+    assert api["calls"] > 3
+    api["down"] = False
+    for _ in range(20):
+        await asyncio.sleep(0.1)
+        state = (await ds.client.get("/-/big-local-circuit", cookies=root)).json()
+        if state["state"] == "closed":
+            break
+    assert state["state"] == "closed"
+    response = await ds.client.get(
+        "/" + project_uuid, cookies=cookies(ds, "3", token="3")
+    )
+    assert response.status_code == 200
+
+
+def test_stale_grants_are_opt_in(make_ds):
+    import time
+    from datasette_big_local import get_stale_permissions, stale_permission
+
+    key = ("1", "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    ds = make_ds()
+    get_stale_permissions(ds)[key] = (True, time.monotonic())
+    assert stale_permission(ds, key) is None
+    get_stale_permissions(ds)[key] = (False, time.monotonic())
+    assert stale_permission(ds, key) is False
+
+    ds = make_ds(stale_grant_ttl=300)
+    get_stale_permissions(ds)[key] = (True, time.monotonic())
+    assert stale_permission(ds, key) is True
+    get_stale_permissions(ds)[key] = (True, time.monotonic() - 301)
+    assert stale_permission(ds, key) is None
+
+
+@pytest.mark.asyncio
+async def test_query_result_cache(make_ds):
+    from datasette_big_local import ensure_database, get_metrics, get_query_cache
+
+    ds = make_ds(query_cache_mb=1, query_cache_max_result_kb=4)
+    db = ensure_database(ds, "ff0150c6-b634-472a-81b2-ef2e0c01d224")
+    await db.execute_write_fn(
+        lambda conn: sqlite_utils.Database(conn)["t"].insert_all(
+            {"id": i, "state": ["CA", "NY"][i % 2]} for i in range(1000)
+        )
+    )
+    query_cache = get_query_cache(ds)
+    sql = "select state, count(*) from t where id > :min group by state"
+
+    async def run(params={"min": 0}):
+        return [tuple(row) for row in (await db.execute(sql, params)).rows]
+
+    assert await run() == [("CA", 499), ("NY", 500)]
+    assert len(query_cache.entries) == 1
+    # Served from the cache, keyed on the parameters too
+    assert await run() == [("CA", 499), ("NY", 500)]
+    assert await run({"min": 500}) == [("CA", 249), ("NY", 250)]
+    metrics = get_metrics(ds).render()
+    assert "big_local_query_cache_hits_total 1" in metrics
+    assert "big_local_query_cache_misses_total 2" in metrics
+
+    # Writes through the database drop its cached results, and only its own
+    other = ensure_database(ds, "2a6e4b2c-8f3d-4d6a-9b1e-5c7f0e9d3a21")
+    await other.execute_write("create table t (id integer)")
+    await other.execute("select count(*) from t")
+    await db.execute_write("delete from t where id < 10")
+    assert [key[0] for key in query_cache.entries] == [other.name]
+    assert list(query_cache.database_keys) == [other.name]
+    query_cache.invalidate(other.name)
+    assert not query_cache.entries
+    assert await run() == [("CA", 495), ("NY", 495)]
+
+    # As do writes by another worker, which change the database files
+    conn = sqlite3.connect(db.path)
+    conn.execute("delete from t where id < 20")
+    conn.commit()
+    conn.close()
+    assert await run() == [("CA", 490), ("NY", 490)]
+
+    # Results over query_cache_max_result_kb are not cached
+    query_cache.invalidate(db.name)
+    assert query_cache.size == 0
+    assert len((await db.execute("select * from t")).rows) == 980
+    assert not query_cache.entries
+    # Nor are results that depend on more than the data
+    await db.execute("select random()")
+    assert not query_cache.entries
+
+
+def create_legacy_database(path, tables):
+    "A project database as imported before progress rows had a stage"
+    database = sqlite_utils.Database(str(path))
+    for i, (table, rows) in enumerate(tables.items()):
+        database[table].insert_all(rows)
+        database["_import_progress_"].insert(
+            {
+                "id": "legacy-{}".format(i),
+                "table": table,
+                "bytes_todo": 1000,
+                "bytes_done": 1000,
+                "rows_done": len(rows),
+                "started": "2022-01-0{} 00:00:00".format(i + 1),
+                "completed": "2022-01-0{} 00:01:00".format(i + 1),
+            },
+            pk="id",
+        )
+    database.close()
+
+
+@pytest.mark.asyncio
+async def test_import_progress_migrated_on_open(ds, tmpdir):
+    from datasette_big_local import ensure_database, get_settings, import_file
+
+    project_uuid = "ff0150c6-b634-472a-81b2-ef2e0c01d224"
+    create_legacy_database(
+        pathlib.Path(tmpdir) / "{}.db".format(project_uuid),
+        {"t": [{"id": 1}]},
+    )
+    db = ensure_database(ds, project_uuid)
+    # The first read opens the write connection, which adds the new columns
+    rows = (await db.execute("select stage, source_etag from _import_progress_")).rows
+    assert [tuple(row) for row in rows] == [("import", None)]
+    # Already imported, so there is nothing to do
+    assert not await import_file(db, "https://storage.googleapis.com/t.csv", "t")
+    assert not get_settings(ds).auto_fts
+
+
+@pytest.mark.asyncio
+async def test_disk_quota_evicts_legacy_tables(ds, tmpdir):
+    from datasette_big_local import enforce_disk_quotas, evict_table
+
+    project_uuid = "ff0150c6-b634-472a-81b2-ef2e0c01d224"
+    db_path = pathlib.Path(tmpdir) / "{}.db".format(project_uuid)
+    rows = [{"id": i, "text": "row {}".format(i) * 20} for i in range(500)]
+    create_legacy_database(db_path, {"old": rows, "older": rows, "oldest": rows})
+
+    # Straight against the schema from before stages were recorded
+    conn = sqlite3.connect(str(db_path))
+    evict_table(conn, "oldest")
+    # And for a table with no progress rows at all
+    conn.execute("alter table _import_progress_ add column stage text")
+    conn.execute("alter table _import_progress_ add column source_etag text")
+    conn.execute("delete from _import_progress_ where [table] = 'older'")
+    conn.commit()
+    evict_table(conn, "older")
+    assert conn.execute(
+        "select [table], source_etag, bytes from _evicted_tables_ order by [table]"
+    ).fetchall() == [("older", None, None), ("oldest", None, 1000)]
+    conn.close()
+
+    ds._metadata_local["plugins"]["datasette-big-local"]["project_quota_mb"] = 0.001
+    assert await enforce_disk_quotas(ds) == [(project_uuid, "old")]
+
+
+@pytest.mark.asyncio
+async def test_stats_reloaded_from_other_workers(monkeypatch, make_ds):
+    import datasette_big_local
+    from datasette_big_local import ensure_database, evict_table, save_table_stats
+
+    project_uuid = "ff0150c6-b634-472a-81b2-ef2e0c01d224"
+    workers = [make_ds() for _ in range(2)]
+    one, two = [ensure_database(worker, project_uuid) for worker in workers]
+    await one.execute_write_fn(
+        lambda conn: save_table_stats(conn, "t", {"row_count": 100, "columns": {}})
+    )
+    await one.execute_write("create table t (id integer)")
+    await one.execute_write("create table gone (id integer)")
+    assert (await two.execute("select count(*) from t")).single_value() == 100
+    assert await two.evicted_tables() == {}
+
+    # The first worker imports t again and evicts another table
+    await one.execute_write_fn(
+        lambda conn: save_table_stats(conn, "t", {"row_count": 5, "columns": {}})
+    )
+    await one.execute_write_fn(lambda conn: evict_table(conn, "gone"))
+    monkeypatch.setattr(datasette_big_local, "SCHEMA_CHECK_SECONDS", 0)
+    await asyncio.sleep(0.01)
+    assert (await two.execute("select count(*) from t")).single_value() == 5
+    assert list(await two.evicted_tables()) == ["gone"]
+
+
+@pytest.mark.asyncio
+async def test_import_whole_project_progress_for_legacy_database(ds, tmpdir):
+    from datasette_big_local import BulkImport, ensure_database, get_bulk_imports
+
+    project_uuid = "ff0150c6-b634-472a-81b2-ef2e0c01d224"
+    db_path = pathlib.Path(tmpdir) / "{}.db".format(project_uuid)
+    create_legacy_database(db_path, {"t_2e_csv": [{"id": 1}]})
+    # Written by an older version without the stage column
+    db = ensure_database(ds, project_uuid)
+    get_bulk_imports(ds)[project_uuid] = BulkImport(["t.csv", "u.csv"])
+    files = await get_bulk_imports(ds)[project_uuid].progress(db)
+    assert [(file["filename"], file["rows_done"]) for file in files] == [
+        ("t.csv", 1),
+        ("u.csv", None),
+    ]